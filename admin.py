@@ -0,0 +1,79 @@
+# Inventory admin tool, works with the same database as running bot
+#
+#   python admin.py stock [--days 7]
+#   python admin.py import germany new-keys.txt [--used]
+#   python admin.py export sales.csv [--since 2024-01-01]
+#   python admin.py compact [--archive keys/archive]
+#
+# Files are streamed line by line, so multi-million-line files need constant memory
+# Bot picks up changes made here on next inventory check (KEYS_WATCH_INTERVAL)
+import config # Config with all bot data
+import argparse
+import os
+
+import inventory # VPN keys storage
+
+# Stock table: free and sold keys, sell-through per day and days until country runs out
+def format_report(report, days) -> str:
+    lines = [f'Страна: свободно / продано всего / за {days} дн. / в день / хватит на']
+    for country, row in report.items():
+        days_left = f"{row['days_left']:.1f} дн." if row['days_left'] is not None else '—'
+        lines.append(f"{country}: {row['free']} / {row['used']} / {row['sold']} / {row['rate']:.1f} / {days_left}")
+    return '\n'.join(lines)
+
+def stock(keys, args):
+    print(format_report(keys.report(args.days), args.days))
+
+def import_keys(keys, args):
+    state = inventory.USED if args.used else inventory.FREE
+    added = keys.add(args.country, inventory.read_keys(args.file), state)
+    print(f'Added {added} keys to {args.country}')
+
+def export(keys, args):
+    count = keys.export_sales(args.output, args.since)
+    print(f'Exported {count} sales to {args.output}')
+
+# Countries that have {country}.txt or used_{country}.txt in keys folder
+def file_countries(folder):
+    for name in os.listdir(folder):
+        if name.endswith('.txt'):
+            name = name[:-len('.txt')]
+            yield name[len('used_'):] if name.startswith('used_') else name
+
+def compact(keys, args):
+    countries = sorted(set(args.countries) | set(file_countries(config.KEYS_FOLDER)))
+    for country, (archived, removed) in keys.compact_files(config.KEYS_FOLDER, countries, args.archive).items():
+        print(f'{country}: archived {archived} used keys, removed {removed} sold keys from {country}.txt')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VPN keys inventory admin')
+    parser.add_argument('--database', default=config.DATABASE)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('stock', help='Free and sold keys per country')
+    command.add_argument('--days', type=int, default=7, help='Period for sell-through rate')
+    command.set_defaults(run=stock)
+
+    command = commands.add_parser('import', help='Import keys from file, known keys are skipped')
+    command.add_argument('country')
+    command.add_argument('file')
+    command.add_argument('--used', action='store_true', help='Keys were already sold')
+    command.set_defaults(run=import_keys)
+
+    command = commands.add_parser('export', help='Export sales to CSV')
+    command.add_argument('output')
+    command.add_argument('--since', help='Date like 2024-01-31')
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('compact', help='Archive used_*.txt and remove sold keys from keys files')
+    command.add_argument('--archive', default=config.KEYS_ARCHIVE)
+    command.add_argument('countries', nargs='*')
+    command.set_defaults(run=compact)
+
+    args = parser.parse_args()
+
+    keys = inventory.KeyInventory(args.database)
+    try:
+        args.run(keys, args)
+    finally:
+        keys.close()
@@ -0,0 +1,835 @@
+# Benchmarks of separate bot parts, every command prints its numbers as a table
+#
+#   python bench.py confirm [--taps 200]
+#   python bench.py claim [--sizes 1000 10000 100000 1000000]
+#   python bench.py sessions [--users 1000000]
+#   python bench.py start [--users 5000]
+#   python bench.py lookup [--rows 1000000]
+#   python bench.py keyboards [--starts 10000]
+#   python bench.py sender [--messages 500 --chats 100]
+#   python bench.py webhook [--workers 1 2 4]
+#   python bench.py sweep [--subscriptions 1000000 --due 10000]
+#   python bench.py throttle [--updates 50000]
+#   python bench.py metrics [--updates 200000]
+#   python bench.py notify [--payments 5000 --rate 1000]
+#
+# Fake servers listen on localhost, databases and files live in temporary folder
+import config # Defaults, benchmarks pass config.override() copies to bot modules
+import argparse
+import asyncio
+import collections
+import datetime
+import gc
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import loadtest # Fake Telegram and YooKassa servers
+
+from aiohttp import web
+
+# How late event loop wakes up, blocked loop makes every other user wait
+class LoopLag():
+    def __init__(self, tick=0.005):
+        self.tick = tick
+        self.lags = []
+        self.task = None
+
+    async def measure(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.tick)
+            self.lags.append(time.perf_counter() - start - self.tick)
+
+    def start(self):
+        self.task = asyncio.create_task(self.measure())
+
+    async def stop(self) -> float:
+        # Let tick that was delayed by the last blocked step be recorded
+        await asyncio.sleep(self.tick * 2)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        return max(self.lags, default=0)
+
+# Row of latency percentiles in milliseconds
+def latency_row(name, values) -> str:
+    values = sorted(values)
+    return (f'{name:<16}{len(values):>8}{loadtest.percentile(values, 0.5) * 1000:>10.1f}'
+            f'{loadtest.percentile(values, 0.99) * 1000:>10.1f}{values[-1] * 1000 if values else 0:>10.1f}')
+
+LATENCY_HEADER = f'{"":<16}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}'
+
+# Concurrent "confirm payment" taps against fake YooKassa: latency of payment.check() and event loop lag
+async def confirm(args):
+    import payment
+
+    kassa = loadtest.FakeYooKassa(delay=args.kassa_delay)
+    port = loadtest.free_port()
+    runner = await loadtest.serve(kassa.app, port)
+    payment.configure(config.override(ACCOUNT_ID='1', SECRET_KEY='bench', YOOKASSA_API_URL=f'http://127.0.0.1:{port}/v3',
+                                      PAYMENT_WORKERS=args.workers))
+
+    created = await asyncio.gather(*(payment.create('100.00', chat_id, 'bench') for chat_id in range(args.taps)))
+    for _, pay_id in created:
+        kassa.pay(pay_id)
+
+    async def tap(pay_id):
+        start = time.perf_counter()
+        assert await payment.check(pay_id, args.interval, 1)
+        return time.perf_counter() - start
+
+    lag = LoopLag()
+    lag.start()
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(tap(pay_id) for _, pay_id in created))
+    elapsed = time.perf_counter() - started
+    max_lag = await lag.stop()
+    await runner.cleanup()
+
+    print(f'{args.taps} simultaneous taps, poll interval {args.interval * 1000:.0f} ms, '
+          f'{args.workers} YooKassa workers, fake YooKassa delay {args.kassa_delay * 1000:.0f} ms')
+    print(LATENCY_HEADER)
+    print(latency_row('confirm', latencies))
+    print(f'\nAll taps answered in {elapsed:.2f}s, max event loop lag {max_lag * 1000:.1f} ms')
+
+# Sale as it was done before inventory: read whole keys file, move first line to used file, rewrite the rest
+def file_claim(path, used_path):
+    with open(path, 'r') as file:
+        lines = file.readlines()
+
+    with open(used_path, 'a') as used_file:
+        used_file.write(lines[0])
+
+    with open(path, 'w') as file:
+        file.writelines(lines[1:])
+
+    return lines[0].strip()
+
+# Time every call of func(i), returns list of seconds
+def timed(func, count) -> list:
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+# Key claim latency by inventory size, SQLite inventory against rewriting keys file
+def claim(args):
+    import inventory
+
+    print(f'{"keys":>10}{"import s":>10}{"claim p50 us":>14}{"p99 us":>10}{"file p50 ms":>13}{"p99 ms":>10}')
+    for size in args.sizes:
+        folder = tempfile.mkdtemp(prefix='bench-')
+        try:
+            keys = inventory.KeyInventory(os.path.join(folder, 'keys.db'))
+            start = time.perf_counter()
+            keys.add('bench', (f'vless://bench-{i}' for i in range(size)))
+            imported = time.perf_counter() - start
+
+            claims = timed(lambda i: keys.claim('bench', i, 'user', f'pay-{i}'), min(args.claims, size))
+            keys.close()
+
+            path, used_path = os.path.join(folder, 'bench.txt'), os.path.join(folder, 'used_bench.txt')
+            with open(path, 'w') as file:
+                file.writelines(f'vless://bench-{i}\n' for i in range(size))
+            file_claims = timed(lambda i: file_claim(path, used_path), min(args.file_claims, size))
+        finally:
+            shutil.rmtree(folder)
+
+        print(f'{size:>10}{imported:>10.2f}'
+              f'{loadtest.percentile(claims, 0.5) * 1e6:>14.0f}{loadtest.percentile(claims, 0.99) * 1e6:>10.0f}'
+              f'{loadtest.percentile(file_claims, 0.5) * 1000:>13.2f}{loadtest.percentile(file_claims, 0.99) * 1000:>10.2f}')
+
+# User data as it was kept before session cache: plain object in dict that never shrinks
+class OldUserData():
+    def __init__(self, user_id):
+        self.subscriped = []
+        self.user_id = user_id
+        self.question_message = None
+        self.country = None
+        self.title = None
+
+# Memory of session storage after many distinct users, bounded cache against old dict
+def sessions(args):
+    import main
+    import sessions as sessions_cache
+
+    def old(storage, user_id):
+        if user_id not in storage:
+            storage[user_id] = OldUserData(user_id)
+        return storage[user_id]
+
+    def new(storage, user_id):
+        return storage.get(user_id)
+
+    def cache():
+        return sessions_cache.SessionCache(main.UserData, args.size, config.SESSION_TTL, config.SESSION_PURCHASE_TTL)
+
+    print(f'{args.users} distinct users, session cache size {args.size}')
+    print(f'{"":<16}{"kept":>10}{"MiB":>10}{"us/user":>10}')
+    for name, storage, get in (('dict', dict, old), ('session cache', cache, new)):
+        # Time is measured without tracemalloc, it slows allocations down
+        items = storage()
+        start = time.perf_counter()
+        for user_id in range(args.users):
+            get(items, user_id)
+        elapsed = time.perf_counter() - start
+        del items
+
+        tracemalloc.start()
+        items = storage()
+        for user_id in range(args.users):
+            get(items, user_id)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f'{name:<16}{len(items):>10}{used / 2 ** 20:>10.1f}{elapsed / args.users * 1e6:>10.2f}')
+        del items
+
+def now() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# /start registrations per second: blocking commit per user in event loop against batching storage
+async def start(args):
+    import migrations
+    import storage
+
+    folder = tempfile.mkdtemp(prefix='bench-')
+    try:
+        # Before: shared connection, lookup and commit right in the handler
+        conn = sqlite3.connect(os.path.join(folder, 'old.db'))
+        migrations.initial_tables(conn)
+
+        async def old_start(user_id):
+            conn.execute("SELECT * FROM subscriptions WHERE user_id=?", (user_id,)).fetchall()
+            if conn.execute("SELECT * FROM potential_customers WHERE username=?", (f'user{user_id}',)).fetchone() is None:
+                conn.execute("INSERT INTO potential_customers VALUES(?, ?)", (f'user{user_id}', now()))
+                conn.commit()
+
+        # After: upsert queued to writer thread, commits shared by concurrent handlers
+        db = storage.Storage(os.path.join(folder, 'new.db'), config.DB_BATCH_SIZE, config.DB_FLUSH_INTERVAL)
+        await migrations.migrate(db)
+
+        async def new_start(user_id):
+            await db.execute('''INSERT INTO potential_customers (user_id, username, date) VALUES(?, ?, ?)
+                                ON CONFLICT(user_id) DO UPDATE SET username=excluded.username''',
+                             (user_id, f'user{user_id}', now()))
+
+        print(f'{args.users} new users, {args.concurrency} at the same time')
+        print(f'{"":<10}{"starts/s":>10}{"max loop lag ms":>17}')
+        for name, handler in (('blocking', old_start), ('storage', new_start)):
+            slots = asyncio.Semaphore(args.concurrency)
+
+            async def user(user_id):
+                async with slots:
+                    await handler(user_id)
+
+            # Garbage of previous run is not collected during this one
+            gc.collect()
+
+            lag = LoopLag()
+            lag.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(user(user_id) for user_id in range(args.users)))
+            elapsed = time.perf_counter() - started
+            max_lag = await lag.stop()
+
+            print(f'{name:<10}{args.users / elapsed:>10.0f}{max_lag * 1000:>17.1f}')
+
+        conn.close()
+        await db.close()
+    finally:
+        shutil.rmtree(folder)
+
+# User lookups on 1M rows: old tables without indexes against migrated schema
+def lookup(args):
+    import migrations
+
+    folder = tempfile.mkdtemp(prefix='bench-')
+    try:
+        old = sqlite3.connect(os.path.join(folder, 'old.db'))
+        migrations.initial_tables(old)
+        old.executemany("INSERT INTO potential_customers VALUES(?, ?)",
+                        ((f'user{i}', now()) for i in range(args.rows)))
+        old.executemany("INSERT INTO subscriptions VALUES(?, ?, ?)",
+                        ((i, 'plan', f'vless://bench-{i}') for i in range(args.rows)))
+        old.commit()
+
+        new = sqlite3.connect(os.path.join(folder, 'new.db'))
+        migrations.apply_migrations(new)
+        new.executemany("INSERT INTO potential_customers (user_id, username, date) VALUES(?, ?, ?)",
+                        ((i, f'user{i}', now()) for i in range(args.rows)))
+        new.executemany("INSERT INTO subscriptions (user_id, offer, key, purchased_at, expires_at) VALUES(?, ?, ?, ?, ?)",
+                        ((i, 'plan', f'vless://bench-{i}', now(), now()) for i in range(args.rows)))
+        new.commit()
+
+        users = [random.randrange(args.rows) for _ in range(args.lookups)]
+        queries = (
+            ('/start user', lambda i: old.execute("SELECT * FROM potential_customers WHERE username=?", (f'user{users[i]}',)).fetchone(),
+                            lambda i: new.execute('''INSERT INTO potential_customers (user_id, username, date) VALUES(?, ?, ?)
+                                                     ON CONFLICT(user_id) DO UPDATE SET username=excluded.username''',
+                                                  (users[i], f'user{users[i]}', now()))),
+            ('subscriptions', lambda i: old.execute("SELECT offer, key FROM subscriptions WHERE user_id=?", (users[i],)).fetchall(),
+                              lambda i: new.execute("SELECT offer, key FROM subscriptions WHERE user_id=? AND (expires_at IS NULL OR expires_at>?)",
+                                                    (users[i], now())).fetchall()),
+        )
+
+        print(f'{args.rows} rows, {args.lookups} random users')
+        print(f'{"":<16}{"scan us":>10}{"index us":>10}')
+        for name, scan, indexed in queries:
+            scans, lookups = timed(scan, args.lookups), timed(indexed, args.lookups)
+            print(f'{name:<16}{loadtest.percentile(scans, 0.5) * 1e6:>10.0f}{loadtest.percentile(lookups, 0.5) * 1e6:>10.0f}')
+        new.commit()
+
+        start = time.perf_counter()
+        migrations.apply_migrations(old)
+        print(f'\nMigrating old database: {time.perf_counter() - start:.1f}s')
+
+        old.close()
+        new.close()
+    finally:
+        shutil.rmtree(folder)
+
+# /start answers against fake Bot API: getMe and menu built per message against prebuilt interface
+async def keyboards(args):
+    import main
+    import settings
+    import keyboards as interface
+
+    from aiogram import Bot
+    from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+    tg = loadtest.FakeTelegram()
+    port = loadtest.free_port()
+    runner = await loadtest.serve(tg.app, port)
+    bot = Bot(token='123456:BENCH', session=main.create_session(f'http://127.0.0.1:{port}'))
+    texts = settings.current
+
+    # Before: bot name is asked and keyboard is built for every /start
+    def old_answer(bot_info):
+        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=texts.BUY), KeyboardButton(text=texts.SUBSCRIPTIONS)],
+                                           [KeyboardButton(text=texts.REVIEWS), KeyboardButton(text=texts.SUPPORT)]],
+                                 resize_keyboard=True)
+        return f"👋 Добро пожаловать в бота {bot_info.full_name}\n\n🚀 Здесь ты можешь оформить и пользоваться нашим VPN 24/7 без ограничений", kb
+
+    async def old_start(chat_id):
+        text, kb = old_answer(await bot.get_me())
+        await bot.send_message(chat_id, text, reply_markup=kb)
+
+    # After: name is fetched once, handler reuses prebuilt texts and keyboard
+    ui = interface.Interface(texts, (await bot.get_me()).full_name)
+
+    async def new_start(chat_id):
+        await bot.send_message(chat_id, ui.welcome, reply_markup=ui.menu)
+
+    bot_info = await bot.get_me()
+    build = timed(lambda i: old_answer(bot_info), args.starts)
+
+    print(f'{args.starts} /start answers, {args.concurrency} at the same time')
+    print(f'{"":<12}{"API calls":>10}{"starts/s":>10}{"CPU us/start":>14}')
+    for name, handler in (('per message', old_start), ('prebuilt', new_start)):
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def user(chat_id):
+            async with slots:
+                await handler(chat_id)
+
+        gc.collect()
+        calls = sum(tg.calls.values())
+        started, cpu = time.perf_counter(), time.process_time()
+        await asyncio.gather(*(user(chat_id) for chat_id in range(args.starts)))
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+        tg.inbox.clear()
+
+        print(f'{name:<12}{sum(tg.calls.values()) - calls:>10}{args.starts / elapsed:>10.0f}{cpu / args.starts * 1e6:>14.0f}')
+
+    # Fake Bot API answers in the same process, so its CPU is counted too
+    print(f'\nBuilding menu and welcome text: {sum(build) / len(build) * 1e6:.1f} us per message')
+
+    await bot.session.close()
+    await runner.cleanup()
+
+# Fake Bot API with Telegram flood limits: messages above them get 429 with retry_after
+class FloodTelegram(loadtest.FakeTelegram):
+    def __init__(self, global_rate=30, chat_burst=3, chat_period=1):
+        super().__init__()
+        self.global_rate = global_rate
+        self.chat_burst = chat_burst
+        self.chat_period = chat_period
+        self.sent = collections.deque() # Times of messages in last second
+        self.chat_sent = collections.defaultdict(collections.deque) # chat_id -> times of messages in last chat_period
+        self.flooded = 0
+
+    def allow(self, chat_id) -> bool:
+        now = time.monotonic()
+        chat_sent = self.chat_sent[chat_id]
+        for sent, period in ((self.sent, 1), (chat_sent, self.chat_period)):
+            while sent and sent[0] <= now - period:
+                sent.popleft()
+
+        if len(self.sent) >= self.global_rate or len(chat_sent) >= self.chat_burst:
+            return False
+
+        self.sent.append(now)
+        chat_sent.append(now)
+        return True
+
+    async def handle(self, request):
+        if request.match_info['method'] == 'sendMessage':
+            params = await request.json() if request.content_type == 'application/json' else dict(await request.post())
+            if not self.allow(int(params['chat_id'])):
+                self.flooded += 1
+                return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                          'parameters': {'retry_after': 1}}, status=429)
+        return await super().handle(request)
+
+# Sustained messages per second to fake Bot API with flood limits: direct sends against send queue
+async def sender(args):
+    import main
+    import sender as outbound
+
+    from aiogram import Bot
+
+    print(f'{args.messages} messages to {args.chats} chats, every {args.delivery_every}th is key delivery')
+    print(f'{"":<8}{"sent":>7}{"failed":>8}{"429":>6}{"msgs/s":>8}{"delivery p99 ms":>17}{"other p99 ms":>14}')
+
+    for name in ('direct', 'sender'):
+        tg = FloodTelegram()
+        port = loadtest.free_port()
+        runner = await loadtest.serve(tg.app, port)
+        bot = Bot(token='123456:BENCH', session=main.create_session(f'http://127.0.0.1:{port}'))
+
+        queue = outbound.Sender(bot, config.SEND_GLOBAL_RATE, config.SEND_CHAT_RATE, config.SEND_CHAT_BURST,
+                                config.SEND_WORKERS, config.SEND_MAX_RETRIES)
+        queue.start()
+        latency = collections.defaultdict(list)
+        failed = 0
+
+        async def send(i):
+            nonlocal failed
+            delivery = i % args.delivery_every == 0
+            start = time.perf_counter()
+            try:
+                if name == 'direct':
+                    await bot.send_message(i % args.chats, 'bench')
+                else:
+                    await queue.send_message(i % args.chats, 'bench', outbound.DELIVERY if delivery else outbound.NORMAL)
+            except Exception:
+                failed += 1
+                return
+            latency['delivery' if delivery else 'other'].append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(args.messages)))
+        elapsed = time.perf_counter() - started
+
+        await queue.stop()
+        await bot.session.close()
+        await runner.cleanup()
+
+        sent = args.messages - failed
+        delivery, other = sorted(latency['delivery']), sorted(latency['other'])
+        print(f'{name:<8}{sent:>7}{failed:>8}{tg.flooded:>6}{sent / elapsed:>8.1f}'
+              f'{loadtest.percentile(delivery, 0.99) * 1000:>17.0f}{loadtest.percentile(other, 0.99) * 1000:>14.0f}')
+
+# Webhook worker process, spawned process builds its app from config with test overrides
+def webhook_process(overrides, workers):
+    logging.basicConfig(level=logging.WARNING)
+
+    import main
+    main.create_app(config.override(**overrides))
+    main.run_webhook_worker(workers)
+
+# Recorded updates: every user sends /start and taps buy, each update gets one answer
+def recorded_updates(users) -> list:
+    import settings
+
+    tg = loadtest.FakeTelegram()
+    for chat_id in range(users):
+        tg.send_text(1000000 + chat_id, '/start')
+        tg.send_text(1000000 + chat_id, settings.current.BUY)
+    return [tg.updates.get_nowait() for _ in range(tg.updates.qsize())]
+
+# Updates per second served by webhook workers, updates are replayed into webhook endpoint
+async def webhook(args):
+    import aiohttp
+    import migrations
+
+    print(f'{args.users * 2} updates from {args.users} users, {args.concurrency} requests at the same time, {os.cpu_count()} CPUs')
+    print(f'{"workers":>8}{"accepted/s":>12}{"answered/s":>12}{"p99 answer ms":>15}')
+
+    for workers in args.workers:
+        folder = tempfile.mkdtemp(prefix='bench-')
+        tg = loadtest.FakeTelegram()
+        tg_port, port = loadtest.free_port(), loadtest.free_port()
+        runner = await loadtest.serve(tg.app, tg_port)
+
+        overrides = {'TOKEN': '123456:BENCH',
+                     'TELEGRAM_API_URL': f'http://127.0.0.1:{tg_port}',
+                     'DATABASE': os.path.join(folder, 'bench.db'),
+                     'KEYS_FOLDER': os.path.join(folder, 'keys'),
+                     'SETTINGS_FILE': os.path.join(folder, 'settings.json'),
+                     'WEBHOOK_HOST': '127.0.0.1',
+                     'WEBHOOK_PORT': port,
+                     # Fake Bot API has no flood limits, sends must not be the bottleneck
+                     'SEND_GLOBAL_RATE': 100000}
+        os.makedirs(overrides['KEYS_FOLDER'])
+
+        # Database is migrated once, like run_webhook() does before starting workers
+        conn = sqlite3.connect(overrides['DATABASE'])
+        migrations.apply_migrations(conn)
+        conn.close()
+
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=webhook_process, args=(overrides, workers)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+
+        try:
+            # Every worker asks bot name on startup, then starts listening
+            while tg.calls['getMe'] < workers:
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(1)
+
+            updates = recorded_updates(args.users)
+            slots = asyncio.Semaphore(args.concurrency)
+            sent = {}
+
+            async with aiohttp.ClientSession() as session:
+                async def post(update):
+                    async with slots:
+                        chat_id = update['message']['chat']['id']
+                        sent.setdefault(chat_id, []).append(time.perf_counter())
+                        async with session.post(f'http://127.0.0.1:{port}{config.WEBHOOK_PATH}', data=json.dumps(update),
+                                                headers={'Content-Type': 'application/json',
+                                                         'X-Telegram-Bot-Api-Secret-Token': config.WEBHOOK_SECRET}) as response:
+                            assert response.status == 200
+
+                async def answers(chat_id):
+                    latencies = []
+                    for _ in range(2):
+                        call = await tg.expect(chat_id, lambda call: call.method == 'sendMessage', args.timeout)
+                        latencies.append(call.time - sent[chat_id][len(latencies)])
+                    return latencies
+
+                started = time.perf_counter()
+                waiting = asyncio.gather(*(answers(1000000 + chat_id) for chat_id in range(args.users)))
+                await asyncio.gather(*(post(update) for update in updates))
+                accepted = time.perf_counter() - started
+                latencies = sorted(sum(await waiting, []))
+                answered = time.perf_counter() - started
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            await runner.cleanup()
+            shutil.rmtree(folder)
+
+        print(f'{workers:>8}{len(updates) / accepted:>12.0f}{len(updates) / answered:>12.0f}'
+              f'{loadtest.percentile(latencies, 0.99) * 1000:>15.0f}')
+
+# Reminders sweep over 1M subscriptions: due rows are taken by partial index, not by scanning all users
+async def sweep(args):
+    import migrations
+    import reminders
+    import storage
+
+    folder = tempfile.mkdtemp(prefix='bench-')
+    try:
+        path = os.path.join(folder, 'bench.db')
+        conn = sqlite3.connect(path)
+        migrations.apply_migrations(conn)
+
+        # Due subscriptions expire within the next hour, others during the next year
+        now = datetime.datetime.now()
+        def subscription(i):
+            expires_at = now + datetime.timedelta(hours=1) if i < args.due else now + datetime.timedelta(days=2 + i % 360)
+            return (i, 'plan', f'vless://bench-{i}', reminders.timestamp(expires_at - datetime.timedelta(days=30)),
+                    reminders.timestamp(expires_at))
+
+        conn.executemany("INSERT INTO subscriptions (user_id, offer, key, purchased_at, expires_at) VALUES(?, ?, ?, ?, ?)",
+                         (subscription(i) for i in range(args.subscriptions)))
+        conn.commit()
+
+        # First batch of due rows with partial index and with table scan
+        query = f'''SELECT id FROM subscriptions {{}} WHERE reminded=0 AND expires_at<=?
+                    ORDER BY expires_at LIMIT {config.REMINDERS_BATCH_SIZE}'''
+        deadline = (reminders.timestamp(now + datetime.timedelta(seconds=config.REMIND_BEFORE)),)
+        indexed = timed(lambda i: conn.execute(query.format(''), deadline).fetchall(), 20)
+        scanned = timed(lambda i: conn.execute(query.format('NOT INDEXED'), deadline).fetchall(), 5)
+        conn.close()
+
+        db = storage.Storage(path, config.DB_BATCH_SIZE, config.DB_FLUSH_INTERVAL)
+        sweeper = reminders.Reminders(db, config.REMINDERS_BATCH_SIZE, config.REMIND_BEFORE, config.NUDGE_AFTER)
+
+        async def remind(user_id, offer, expires_at):
+            pass
+
+        async def nudge(chat_id):
+            pass
+
+        start = time.perf_counter()
+        sent = await sweeper.sweep(remind, nudge)
+        full = time.perf_counter() - start
+
+        # Mostly flush interval: every write waits for others to share its commit
+        start = time.perf_counter()
+        await sweeper.sweep(remind, nudge)
+        idle = time.perf_counter() - start
+        await db.close()
+    finally:
+        shutil.rmtree(folder)
+
+    print(f'{args.subscriptions} subscriptions, {args.due} due, batch {config.REMINDERS_BATCH_SIZE}')
+    print(f'Due batch query: index {loadtest.percentile(indexed, 0.5) * 1000:.2f} ms, '
+          f'table scan {loadtest.percentile(scanned, 0.5) * 1000:.0f} ms')
+    print(f'Sweep of {sent} due reminders: {full:.2f}s ({sent / full:.0f}/s), next sweep with nothing due: {idle * 1000:.1f} ms '
+          f'(2 writes, {config.DB_FLUSH_INTERVAL * 1000:.0f} ms flush interval each)')
+
+# Anti-flood middleware overhead per update against calling handler directly
+# Every update is parsed right before it's handled, like dispatcher does, so event is in CPU cache
+async def throttle(args):
+    import catalog
+    import throttling
+
+    from aiogram.types import Update
+
+    def scenario(send):
+        tg = loadtest.FakeTelegram()
+        for i in range(args.updates):
+            send(tg, i)
+        return [tg.updates.get_nowait() for _ in range(tg.updates.qsize())]
+
+    plan = catalog.PlanCallback(country=catalog.ANY_COUNTRY, plan='month').pack()
+    scenarios = (('new chats', lambda tg, i: tg.send_text(1000000 + i, '/start')),
+                 ('one chat', lambda tg, i: tg.send_text(1, f'/start {i}')),
+                 ('plan taps', lambda tg, i: tg.send_callback(1000000 + i, plan)))
+
+    async def handler(event, data):
+        return True
+
+    print(f'{args.updates} updates per scenario, max {args.max_chats} chats')
+    print(f'{"":<12}{"direct us":>11}{"middleware us":>15}{"overhead us":>13}{"passed":>9}{"chats kept":>12}')
+    for name, send in scenarios:
+        updates = scenario(send)
+        limits = throttling.ThrottlingMiddleware({throttling.MENU: (config.THROTTLE_MENU_RATE, config.THROTTLE_MENU_BURST),
+                                                  throttling.PAYMENT: (config.THROTTLE_PAYMENT_RATE, config.THROTTLE_PAYMENT_BURST)},
+                                                 config.THROTTLE_DEBOUNCE, args.max_chats, config.THROTTLE_IDLE)
+
+        direct = throttled = 0
+        passed = 0
+        for raw in updates:
+            update = Update.model_validate(raw)
+            event = update.message or update.callback_query
+
+            start = time.perf_counter()
+            await handler(event, {})
+            middle = time.perf_counter()
+            passed += await limits(handler, event, {}) is not None
+            end = time.perf_counter()
+
+            direct += middle - start
+            throttled += end - middle
+
+        direct, throttled = direct / len(updates), throttled / len(updates)
+        print(f'{name:<12}{direct * 1e6:>11.2f}{throttled * 1e6:>15.2f}{(throttled - direct) * 1e6:>13.2f}'
+              f'{passed:>9}{len(limits.chats):>12}')
+
+# Metrics cost against budget in metrics.py: a few microseconds per update
+async def metrics_overhead(args):
+    import metrics
+    import monitoring
+
+    from aiogram.dispatcher.event.handler import HandlerObject
+
+    async def start_handler(event, data):
+        return True
+
+    data = {'handler': HandlerObject(callback=start_handler)}
+    middleware = monitoring.HandlerMetricsMiddleware()
+
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        await start_handler(None, data)
+    direct = (time.perf_counter() - start) / args.updates
+
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        await middleware(start_handler, None, data)
+    measured = (time.perf_counter() - start) / args.updates
+
+    histogram = metrics.Histogram('bench_seconds', 'Benchmark')
+    observe = timed(lambda i: histogram.observe(i % 1000 / 1000, 'handler'), args.updates)
+    counter = metrics.Counter('bench_total', 'Benchmark', ('step',))
+    inc = timed(lambda i: counter.inc('start'), args.updates)
+
+    # Scrape of a busy bot: every handler, YooKassa method and funnel step has its series
+    for i in range(args.handlers):
+        metrics.handler_latency.observe(0.01, f'handler_{i}')
+        metrics.handler_errors.inc(f'handler_{i}')
+    render = timed(lambda i: metrics.render(), 100)
+
+    print(f'{"":<24}{"us":>10}')
+    print(f'{"handler":<24}{direct * 1e6:>10.2f}')
+    print(f'{"handler with metrics":<24}{measured * 1e6:>10.2f}')
+    print(f'{"middleware overhead":<24}{(measured - direct) * 1e6:>10.2f}')
+    print(f'{"Histogram.observe":<24}{loadtest.percentile(observe, 0.5) * 1e6:>10.2f}')
+    print(f'{"Counter.inc":<24}{loadtest.percentile(inc, 0.5) * 1e6:>10.2f}')
+    print(f'{"render()":<24}{loadtest.percentile(render, 0.5) * 1e6:>10.0f}  ({len(metrics.render().splitlines())} lines, '
+          f'{args.handlers} handlers)')
+
+# YooKassa notifications posted to settlement route at fixed rate, every payment is notified several times
+# Route, queue, settlement workers and inventory claims are real, keys go to temporary inventory
+async def notify(args):
+    import aiohttp
+    import inventory
+    import settlement
+
+    # Stub YooKassa posts from localhost
+    settlement.trusted_networks.append(ipaddress.ip_network('127.0.0.0/8'))
+
+    folder = tempfile.mkdtemp(prefix='bench-')
+    keys = inventory.KeyInventory(os.path.join(folder, 'bench.db'))
+    keys.add('bench', (f'vless://bench-{i}' for i in range(args.payments)))
+
+    settled = []
+
+    async def handler(pay_id, metadata):
+        key, issued_now, delivered = await keys.run(keys.claim, 'bench', int(metadata['chat_id']), None, pay_id)
+        if key is not None and not delivered:
+            await keys.run(keys.mark_delivered, pay_id)
+        if issued_now:
+            settled.append(time.perf_counter())
+        return key, issued_now
+
+    pipeline = settlement.Settlement(handler, lambda pay_id: keys.run(keys.issued, pay_id))
+    app = web.Application()
+    settlement.add_routes(app, pipeline, config.YOOKASSA_WEBHOOK_PATH)
+    port = loadtest.free_port()
+    runner = await loadtest.serve(app, port)
+    pipeline.start()
+
+    notifications = [{'type': 'notification', 'event': 'payment.succeeded',
+                      'object': {'id': f'pay-{i}', 'status': 'succeeded', 'metadata': {'chat_id': str(i)}}}
+                     for i in range(args.payments) for _ in range(args.repeats)]
+    random.shuffle(notifications)
+    statuses = collections.Counter()
+
+    async with aiohttp.ClientSession() as session:
+        async def post(notification):
+            async with session.post(f'http://127.0.0.1:{port}{config.YOOKASSA_WEBHOOK_PATH}', json=notification) as response:
+                statuses[response.status] += 1
+
+        started = time.perf_counter()
+        posts = []
+        for i, notification in enumerate(notifications):
+            # Fixed rate like YooKassa under load, posts don't wait for each other
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            posts.append(asyncio.create_task(post(notification)))
+        await asyncio.gather(*posts)
+        posted = time.perf_counter() - started
+        await pipeline.queue.join()
+        elapsed = time.perf_counter() - started
+
+    await pipeline.stop()
+    await runner.cleanup()
+    used = sqlite3.connect(keys.path).execute("SELECT COUNT(*), COUNT(DISTINCT pay_id) FROM keys WHERE state=?",
+                                              (inventory.USED,)).fetchone()
+    keys.close()
+    shutil.rmtree(folder)
+
+    print(f'{len(notifications)} notifications for {args.payments} payments at {args.rate:g}/s, {config.SETTLEMENT_WORKERS} workers')
+    print(f'Posted in {posted:.2f}s ({len(notifications) / posted:.0f}/s), answers: {dict(statuses)}')
+    print(f'Settled {len(settled)} payments in {elapsed:.2f}s ({len(settled) / elapsed:.0f}/s)')
+    print(f'Keys issued: {used[0]} for {used[1]} payments, duplicates: {used[0] - used[1]}, '
+          f'missing: {args.payments - used[1]}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bot benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('confirm', help='Concurrent payment confirmations against fake YooKassa')
+    command.add_argument('--taps', type=int, default=200)
+    command.add_argument('--interval', type=float, default=config.PAYMENT_POLL_INTERVAL, help='Pause before status check')
+    command.add_argument('--workers', type=int, default=config.PAYMENT_WORKERS)
+    command.add_argument('--kassa-delay', type=float, default=0.05, help='Seconds fake YooKassa answers')
+    command.set_defaults(run=confirm)
+
+    command = commands.add_parser('claim', help='Key claim latency by inventory size')
+    command.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    command.add_argument('--claims', type=int, default=1000, help='Claims timed per size')
+    command.add_argument('--file-claims', type=int, default=20, help='Claims timed per size with keys file')
+    command.set_defaults(run=claim)
+
+    command = commands.add_parser('sessions', help='Memory of user sessions for many distinct users')
+    command.add_argument('--users', type=int, default=1000000)
+    command.add_argument('--size', type=int, default=config.SESSION_CACHE_SIZE, help='Session cache size')
+    command.set_defaults(run=sessions)
+
+    command = commands.add_parser('start', help='/start registrations per second')
+    command.add_argument('--users', type=int, default=5000)
+    command.add_argument('--concurrency', type=int, default=200)
+    command.set_defaults(run=start)
+
+    command = commands.add_parser('lookup', help='User lookups with table scan and with index')
+    command.add_argument('--rows', type=int, default=1000000)
+    command.add_argument('--lookups', type=int, default=100)
+    command.set_defaults(run=lookup)
+
+    command = commands.add_parser('keyboards', help='API calls and CPU of /start answers with prebuilt keyboards')
+    command.add_argument('--starts', type=int, default=10000)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.set_defaults(run=keyboards)
+
+    command = commands.add_parser('sender', help='Sustained messages per second with Telegram flood limits')
+    command.add_argument('--messages', type=int, default=500)
+    command.add_argument('--chats', type=int, default=100)
+    command.add_argument('--delivery-every', type=int, default=10, help='Every n-th message is key delivery')
+    command.set_defaults(run=sender)
+
+    command = commands.add_parser('webhook', help='Updates per second replayed into webhook workers')
+    command.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    command.add_argument('--users', type=int, default=2000)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.add_argument('--timeout', type=float, default=60, help='Seconds to wait for every answer')
+    command.set_defaults(run=webhook)
+
+    command = commands.add_parser('sweep', help='Reminders sweep over many subscriptions')
+    command.add_argument('--subscriptions', type=int, default=1000000)
+    command.add_argument('--due', type=int, default=10000)
+    command.set_defaults(run=sweep)
+
+    command = commands.add_parser('throttle', help='Anti-flood middleware overhead per update')
+    command.add_argument('--updates', type=int, default=50000)
+    command.add_argument('--max-chats', type=int, default=config.THROTTLE_MAX_CHATS)
+    command.set_defaults(run=throttle)
+
+    command = commands.add_parser('metrics', help='Metrics overhead per update and scrape cost')
+    command.add_argument('--updates', type=int, default=200000)
+    command.add_argument('--handlers', type=int, default=30, help='Handlers with metrics series on scrape')
+    command.set_defaults(run=metrics_overhead)
+
+    command = commands.add_parser('notify', help='YooKassa notifications settled per second')
+    command.add_argument('--payments', type=int, default=5000)
+    command.add_argument('--repeats', type=int, default=2, help='Notifications per payment, YooKassa retries them')
+    command.add_argument('--rate', type=float, default=1000, help='Notifications per second')
+    command.set_defaults(run=notify)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if asyncio.iscoroutinefunction(args.run):
+        asyncio.run(args.run(args))
+    else:
+        args.run(args)
@@ -0,0 +1,60 @@
+# Plans and countries the bot sells, keyboards and purchase flow are generated from here
+# Current plans and countries are in settings.current, these are defaults
+import config
+
+from aiogram.filters.callback_data import CallbackData
+
+class Plan():
+    __slots__ = ('id', 'days', 'price', 'title', 'label', 'discount')
+
+    def __init__(self, id, days, price, title, label, discount=None):
+        self.id = id
+        self.days = days
+        self.price = price
+        self.title = title # Stored in subscriptions and payment
+        self.label = label # Button text
+        self.discount = discount
+
+    # Text of the plan button
+    def button_text(self) -> str:
+        text = f"⭐ {self.label} - {self.price} руб."
+        return f"{text} (-{self.discount}%)" if self.discount else text
+
+class Country():
+    __slots__ = ('id', 'title')
+
+    def __init__(self, id, title):
+        self.id = id # Also name of the keys file
+        self.title = title
+
+# Plans in the order they are shown
+DEFAULT_PLANS = [
+    Plan('one_day', 1, config.ONE_DAY, 'VPN на 1 день', '1 день'),
+    Plan('one_month', 30, config.ONE_MONTH, 'VPN на 1 месяц', '1 месяц'),
+    Plan('three_month', 90, config.THREE_MONTH, 'VPN на 3 месяца', '3 месяца', 14),
+    Plan('six_month', 180, config.SIX_MONTH, 'VPN на 6 месяцев', '6 месяц', 16),
+    Plan('year', 360, config.YEAR, 'VPN на 12 месяцев', '12 месяцев', 20),
+]
+
+# Countries user can choose from the list
+DEFAULT_COUNTRIES = [
+    Country('germany', 'Германия 🇩🇪'),
+    Country('finland', 'Финляндия 🇫🇮'),
+    Country('switz', 'Швейцария 🇨🇭'),
+    Country('turkey', 'Турция 🇹🇷'),
+]
+
+# Keys for "any country" choice are stored separately
+ANY_COUNTRY = 'any_country'
+
+# Structured callback data
+# Country travels with the plan button, so purchase doesn't depend on state kept in one process
+class PlanCallback(CallbackData, prefix='plan'):
+    country: str
+    plan: str
+
+class CountryCallback(CallbackData, prefix='country'):
+    country: str
+
+class PaymentCallback(CallbackData, prefix='pay'):
+    pay_id: str
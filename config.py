@@ -16,8 +16,11 @@ SUB_ERR = '😢 У тебя нет активных подписок'
 SUPPORT_INFO = "✉️ По любым вопросам и проблемам напишите нам: @wowruus"
 BACK_TO_MENU = "🏡 Возвращение в меню"
 PAYMENT_ERROR = 'Извините, на данный момент VPN ключа для этой страны нет. Попробуйте позже.'
+PAYMENT_NO_STOCK = '✅ Оплата получена! Свободные ключи закончились, ваш ключ придёт сюда автоматически, как только запас пополнится.'
+PAYMENT_UNAVAILABLE = '⏳ Платёжная система сейчас не отвечает. Попробуйте, пожалуйста, через пару минут.'
 REMINDER = f'📋Видим, что вы не приобрели подписку, подскажите, у вас возникли сложности с приобретением?'
 PROPOSE_PLAN = f'🛒 Выберите тарифный план:'
+RENEWAL = '⏰ Подписка <b>{offer}</b> заканчивается {date}. Продлите её через «🛒 Купить», чтобы VPN работал без перерыва.'
 
 # PRICES
 ONE_DAY = 10
@@ -25,3 +28,103 @@ ONE_MONTH = 179
 THREE_MONTH = 460
 SIX_MONTH = 900
 YEAR = 1700
+
+# PAYMENTS
+PAYMENT_WORKERS = 8 # Max parallel requests to YooKassa
+PAYMENT_POLL_INTERVAL = 3 # Seconds between payment status checks
+PAYMENT_POLL_ATTEMPTS = 1 # How many times status is checked per confirmation tap
+PAYMENT_TIMEOUT = 10 # Seconds one YooKassa request may take
+PAYMENT_RETRIES = 2 # Extra attempts after timeout or server error
+PAYMENT_RETRY_DELAY = 0.5 # Max pause before first retry, doubles every retry
+BREAKER_FAILURES = 5 # Failed requests in a row that open circuit breaker
+BREAKER_RESET = 30 # Seconds breaker stays open before trial request
+PAYMENT_LINK_TTL = 10 * 60 # Seconds unpaid payment link is offered again for the same plan
+PAYMENT_LINKS_SIZE = 10000
+
+# PAYMENT NOTIFICATIONS
+SETTLEMENT_WORKERS = 4 # Background workers that issue keys for paid orders
+SETTLED_CACHE_SIZE = 10000 # Recently settled payments kept in memory for repeated taps
+YOOKASSA_WEBHOOK_HOST = '0.0.0.0'
+YOOKASSA_WEBHOOK_PORT = 8080
+YOOKASSA_WEBHOOK_PATH = '/yookassa'
+YOOKASSA_IPS = ['185.71.76.0/27', '185.71.77.0/27', '77.75.153.0/25', '77.75.156.11/32',
+                '77.75.156.35/32', '77.75.154.128/25', '2a02:5180::/32']
+
+# STORAGE
+DATABASE = 'user-data.db'
+DB_BATCH_SIZE = 200 # Max writes committed in one transaction
+DB_FLUSH_INTERVAL = 0.02 # Max seconds write waits before commit
+KEYS_FOLDER = 'keys' # Folder with {country}.txt files to import keys from
+KEYS_WATCH_INTERVAL = 10 # Seconds between checks of keys/*.txt for new stock
+KEYS_ARCHIVE = 'keys/archive' # Compacted used_*.txt files are gzipped here
+
+# ADMIN
+ADMINS = [] # Telegram user ids allowed to use /stock, /export, /compact and /import
+ADMIN_REPORT_DAYS = 7 # Period for sell-through rate in /stock
+
+# SESSIONS
+SESSION_CACHE_SIZE = 50000 # Max users kept in memory
+SESSION_TTL = 60 * 60 # Idle user is evicted after this many seconds
+SESSION_PURCHASE_TTL = 24 * 60 * 60 # Same for users with selected country or plan
+SESSION_WARMUP = 0 # Latest buyers preloaded on start in background, 0 disables warm-up
+SESSION_WARMUP_BATCH = 500 # Users loaded by one query
+
+# OUTBOUND MESSAGES
+SEND_GLOBAL_RATE = 25 # Messages per second for the whole bot (Telegram allows ~30)
+SEND_CHAT_RATE = 1 # Messages per second to one chat
+SEND_CHAT_BURST = 3 # Messages to one chat that may go without delay
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 3 # Retries after Telegram flood limit
+
+# INCOMING LIMITS (per chat)
+THROTTLE_MENU_RATE = 1 # Menu messages and buttons per second
+THROTTLE_MENU_BURST = 5 # Taps that may go at once
+THROTTLE_PAYMENT_RATE = 1 / 5 # Plan and payment buttons per second, each may call YooKassa
+THROTTLE_PAYMENT_BURST = 3
+THROTTLE_DEBOUNCE = 1 # Same button or text again within this many seconds is ignored
+THROTTLE_MAX_CHATS = 100000 # Chats with limits kept in memory
+THROTTLE_IDLE = 10 * 60 # Seconds after last update when chat limits are forgotten
+
+# WEBHOOK MODE (python main.py webhook)
+WEBHOOK_URL = 'https://example.com' # Public address of the server
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = 'WEBHOOK_SECRET' # Telegram sends it in every request
+WEBHOOK_WORKERS = 1 # Processes serving updates
+
+# ORDERS RECONCILIATION
+ORDERS_BATCH_SIZE = 50 # Orders checked at once
+ORDERS_INTERVAL = 15 # Seconds between reconciliation runs
+ORDERS_BASE_DELAY = 30 # Seconds before first check of new order, doubles every check
+ORDERS_MAX_DELAY = 30 * 60
+ORDERS_TTL = 24 * 60 * 60 # Unpaid order is expired after this many seconds
+
+# REMINDERS
+REMINDERS_INTERVAL = 60 # Seconds between sweeps
+REMINDERS_BATCH_SIZE = 500 # Rows taken by one query
+REMIND_BEFORE = 24 * 60 * 60 # Seconds before expiry to remind about renewal, short plans get last quarter of term
+NUDGE_AFTER = 60 * 60 # Seconds after unpaid order to ask about problems
+
+# SETTINGS RELOAD
+SETTINGS_FILE = 'settings.json' # Optional, overrides prices, plans, countries and texts above
+SETTINGS_WATCH_INTERVAL = 5 # Seconds between checks of settings file
+
+# METRICS
+METRICS_PATH = '/metrics' # Served next to YooKassa notifications (polling) or webhook (webhook mode)
+LOOP_LAG_INTERVAL = 1 # Seconds between event loop lag probes
+
+# API ENDPOINTS (None means official servers, load test points them to local fakes)
+TELEGRAM_API_URL = None # e.g. 'http://127.0.0.1:8081' for local Bot API server
+YOOKASSA_API_URL = None # e.g. 'http://127.0.0.1:8082/v3'
+PAYMENT_RETURN_URL = 'https://t.me/vpngivverbot'
+
+# Copy of this config with some values replaced, passed to main.create_app() by load test and benchmarks
+def override(**values):
+    from types import SimpleNamespace
+
+    defaults = {name: value for name, value in globals().items() if name.isupper()}
+    unknown = set(values) - set(defaults)
+    if unknown:
+        raise AttributeError(f"Unknown config values: {', '.join(sorted(unknown))}")
+    return SimpleNamespace(**{**defaults, **values})
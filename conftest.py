@@ -0,0 +1 @@
+# Tests import bot modules from the project folder
@@ -0,0 +1,293 @@
+# Key inventory stored in SQLite, replaces rewriting keys/*.txt on every sale
+import sqlite3
+import datetime
+import asyncio
+import logging
+import itertools
+import csv
+import gzip
+import shutil
+import os
+
+import migrations # Database schema
+
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+# Key states
+FREE = 0
+USED = 1
+
+# Keys inserted by one transaction, import of huge file never holds write lock for long
+CHUNK_SIZE = 5000
+
+# Read non-empty stripped lines one by one, file is never loaded into memory
+def read_keys(path):
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield line
+
+class KeyInventory():
+    def __init__(self, path):
+        self.path = path
+        self.conn = None # Opened on first use, so creating inventory costs nothing
+        # Bot calls inventory through this single thread: claims wait for write lock there, not on event loop,
+        # and one connection is never used by two threads at once
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inventory')
+
+        # Free keys per country kept in memory, so handlers don't hit the database on every tap
+        self.counts = {}
+        self.stock = MappingProxyType(self.counts)
+        self.data_version = None
+        self.mtimes = {}
+
+    # Connection with schema, opened when inventory is used first time
+    @property
+    def db(self):
+        if self.conn is None:
+            self.open()
+        return self.conn
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        # Database is in WAL mode (see storage), NORMAL is durable enough there and doesn't fsync every claim
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Bot migrates database on start, admin tool opens inventory without bot, so schema is brought up to date here too
+        migrations.apply_migrations(self.conn)
+        self.refresh()
+
+    # Run inventory method in inventory thread: await keys.run(keys.claim, country, chat_id)
+    async def run(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    # Reload free keys counters from database
+    # Counters are replaced in place after query is done, readers never see empty stock while it runs
+    def refresh(self):
+        counts = dict(self.db.execute("SELECT country, COUNT(*) FROM keys WHERE state=? GROUP BY country", (FREE,)).fetchall())
+        self.counts.update(counts)
+        for country in self.counts.keys() - counts.keys():
+            del self.counts[country]
+        self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    # Atomically take next free key and record who it went to
+    # record(cursor, key) writes purchase rows in the same transaction, so sold key is never left without them
+    # Returns (key, issued_now, delivered), key is None if there are no keys
+    # Payment that already got a key gets the same key back with issued_now=False
+    # delivered is False until mark_delivered(), so key that wasn't sent is sent again by the next settlement
+    def claim(self, country, chat_id, username=None, pay_id=None, record=None) -> tuple:
+        cur = self.db.cursor()
+        # IMMEDIATE lock makes concurrent sales wait instead of taking the same key
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if pay_id is not None:
+                cur.execute("SELECT key, delivered FROM keys WHERE pay_id=?", (pay_id,))
+                issued = cur.fetchone()
+                if issued is not None:
+                    cur.execute("COMMIT")
+                    return issued[0], False, bool(issued[1])
+
+            cur.execute("SELECT id, key FROM keys WHERE country=? AND state=? ORDER BY id LIMIT 1", (country, FREE))
+            row = cur.fetchone()
+
+            if row is not None:
+                cur.execute("UPDATE keys SET state=?, chat_id=?, username=?, issued_at=?, pay_id=?, delivered=0 WHERE id=?",
+                            (USED, chat_id, username, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), pay_id, row[0]))
+                if record is not None:
+                    record(cur, row[1])
+
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None, False, False
+
+        self.counts[country] = max(self.counts.get(country, 1) - 1, 0)
+        return row[1], True, False
+
+    # Key of payment was sent to the user
+    def mark_delivered(self, pay_id):
+        self.db.execute("UPDATE keys SET delivered=1 WHERE pay_id=?", (pay_id,))
+
+    # Key already issued and delivered for payment or None
+    # Undelivered key is not returned, so settlement goes to claim() and sends it again
+    def issued(self, pay_id):
+        row = self.db.execute("SELECT key FROM keys WHERE pay_id=? AND delivered=1", (pay_id,)).fetchone()
+        return row[0] if row else None
+
+    # Count free keys of the country
+    # Counters are loaded when inventory is opened (first import on startup)
+    def available(self, country) -> int:
+        return self.counts.get(country, 0)
+
+    # Add keys to inventory, keys already known in any country are skipped
+    # keys may be any iterable (file lines generator), it's consumed by chunks in constant memory
+    # Dedup is done by keys_key index in database, not by set in memory
+    def add(self, country, keys, state=FREE, chunk_size=CHUNK_SIZE) -> int:
+        added = 0
+        keys = iter(keys)
+        while True:
+            chunk = list(itertools.islice(keys, chunk_size))
+            if not chunk:
+                break
+
+            cur = self.db.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                before = self.db.total_changes
+                cur.executemany("INSERT OR IGNORE INTO keys(country, key, state) SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM keys WHERE key=?)",
+                                ((country, key, state, key) for key in chunk))
+                chunk_added = self.db.total_changes - before
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+
+            added += chunk_added
+            if state == FREE and chunk_added:
+                self.counts[country] = self.counts.get(country, 0) + chunk_added
+
+        return added
+
+    # Import legacy keys/{country}.txt and keys/used_{country}.txt files
+    # Import is idempotent, so it is safe to run on every start and after refilling txt files
+    def import_files(self, folder, countries) -> dict:
+        imported = {}
+        for country in countries:
+            # Used keys go first, so sold keys left in the main file are not sold again
+            for filename, state in ((f"used_{country}.txt", USED), (f"{country}.txt", FREE)):
+                path = os.path.join(folder, filename)
+                if not os.path.exists(path):
+                    continue
+
+                added = self.add(country, read_keys(path), state)
+
+                if state == FREE:
+                    imported[country] = added
+
+        return imported
+
+    # Import txt files again if they were changed since last check
+    def import_changed(self, folder, countries) -> dict:
+        changed = []
+        for country in countries:
+            for filename in (f"used_{country}.txt", f"{country}.txt"):
+                path = os.path.join(folder, filename)
+                mtime = os.path.getmtime(path) if os.path.exists(path) else None
+                if self.mtimes.get(path) != mtime:
+                    self.mtimes[path] = mtime
+                    if country not in changed:
+                        changed.append(country)
+
+        return self.import_files(folder, changed) if changed else {}
+
+    # Import changed files and reload counters if database was changed by another connection
+    def sync(self, folder, countries) -> dict:
+        imported = self.import_changed(folder, countries)
+
+        # data_version changes only when another connection modified the database
+        if self.db.execute("PRAGMA data_version").fetchone()[0] != self.data_version:
+            self.refresh()
+
+        return imported
+
+    # Keep counters fresh: import refilled txt files and pick up changes made by other processes
+    # countries() returns current list of key pools, it may change with settings
+    # Files are read in inventory thread, refill of millions of keys doesn't block event loop
+    async def watch(self, folder, countries, interval):
+        while True:
+            try:
+                imported = await self.run(self.sync, folder, countries())
+                if any(imported.values()):
+                    logging.info("Imported keys: %s", imported)
+            except Exception:
+                logging.exception("Key inventory refresh failed")
+
+            await asyncio.sleep(interval)
+
+    # Free and sold keys per country and sales of last days, counted by database
+    # Returns {country: {'free', 'used', 'sold', 'rate', 'days_left'}}, rate is keys sold per day
+    def report(self, days=7) -> dict:
+        since = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        rows = self.db.execute("""SELECT country,
+                                         SUM(state=?),
+                                         SUM(state=?),
+                                         SUM(state=? AND issued_at>=?)
+                                  FROM keys GROUP BY country ORDER BY country""",
+                               (FREE, USED, USED, since))
+
+        report = {}
+        for country, free, used, sold in rows:
+            rate = sold / days
+            report[country] = {'free': free,
+                               'used': used,
+                               'sold': sold,
+                               'rate': rate,
+                               'days_left': free / rate if rate else None}
+        return report
+
+    # Write sold keys to CSV file row by row, returns number of rows
+    # Plan and amount are taken from orders when sale was paid through YooKassa
+    def export_sales(self, path, since=None) -> int:
+        rows = self.db.execute("""SELECT keys.issued_at, keys.country, keys.key, keys.chat_id, keys.username,
+                                         keys.pay_id, orders.title, orders.amount
+                                  FROM keys LEFT JOIN orders ON orders.pay_id = keys.pay_id
+                                  WHERE keys.state=? AND keys.issued_at>=?
+                                  ORDER BY keys.issued_at""",
+                               (USED, since or ''))
+
+        count = 0
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['issued_at', 'country', 'key', 'chat_id', 'username', 'pay_id', 'plan', 'amount'])
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return count
+
+    # Sold keys live in database, so txt files only need keys that are still free
+    # used_{country}.txt is gzipped into archive folder, {country}.txt is rewritten without sold keys
+    # Files are processed line by line, returns {country: (archived used lines, removed sold lines)}
+    def compact_files(self, folder, countries, archive) -> dict:
+        os.makedirs(archive, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        # Make sure everything from files is in database before files change
+        self.import_files(folder, countries)
+
+        compacted = {}
+        for country in countries:
+            archived = removed = 0
+
+            used_path = os.path.join(folder, f"used_{country}.txt")
+            if os.path.exists(used_path):
+                with open(used_path, 'rb') as source, gzip.open(os.path.join(archive, f"used_{country}-{stamp}.txt.gz"), 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                archived = sum(1 for _ in read_keys(used_path))
+                os.remove(used_path)
+
+            path = os.path.join(folder, f"{country}.txt")
+            if os.path.exists(path):
+                temp = path + '.tmp'
+                with open(temp, 'w') as target:
+                    for key in read_keys(path):
+                        row = self.db.execute("SELECT state FROM keys WHERE key=? ORDER BY state LIMIT 1", (key,)).fetchone()
+                        if row is not None and row[0] == USED:
+                            removed += 1
+                            continue
+                        target.write(key + '\n')
+                # Replace is atomic, bot never reads half written file
+                os.replace(temp, path)
+
+            compacted[country] = (archived, removed)
+
+        return compacted
+
+    def close(self):
+        self.executor.shutdown()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,46 @@
+# Keyboards and texts that never change between messages are built once and reused by handlers
+# New Interface is built when bot name or settings change, handlers always use the latest one
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import ReplyKeyboardRemove
+
+from catalog import PlanCallback, CountryCallback, PaymentCallback
+
+class Interface():
+    def __init__(self, settings, bot_name=''):
+        self.bot_name = bot_name
+
+        # Main menu
+        self.menu = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=settings.BUY), KeyboardButton(text=settings.SUBSCRIPTIONS)],
+                                                  [KeyboardButton(text=settings.REVIEWS), KeyboardButton(text=settings.SUPPORT)]],
+                                        resize_keyboard=True)
+
+        # Country type question after buy button
+        self.country_type = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=settings.ANY_COUNTRY), KeyboardButton(text=settings.COUNTRIES)]],
+                                                resize_keyboard=True)
+
+        # Available countries
+        self.countries = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=country.title,
+                                                                                     callback_data=CountryCallback(country=country.id).pack())]
+                                                               for country in settings.countries.values()])
+
+        # Plans with prices, one keyboard per country
+        self.plans = {country: InlineKeyboardMarkup(inline_keyboard=[*[[InlineKeyboardButton(text=plan.button_text(),
+                                                                                             callback_data=PlanCallback(country=country, plan=plan.id).pack())]
+                                                                       for plan in settings.plans.values()],
+                                                                     [InlineKeyboardButton(text="👈 Меню", callback_data='menu')]])
+                      for country in settings.key_countries}
+
+        self.remove = ReplyKeyboardRemove()
+
+        # Answers to reminder question
+        self.question = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Да', callback_data='yes'),
+                                                               InlineKeyboardButton(text='Нет', callback_data='no')]])
+
+        # Texts with bot name
+        self.welcome = f"👋 Добро пожаловать в бота {self.bot_name}\n\n🚀 Здесь ты можешь оформить и пользоваться нашим VPN 24/7 без ограничений"
+        self.reviews = f'⭐️ Отзывы {self.bot_name}: https://t.me/kvpnchat'
+
+# Order keyboard with payment link and confirmation button
+def order(pay_url, pay_id):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url),
+                                                  InlineKeyboardButton(text='Подтвердить оплату', callback_data=PaymentCallback(pay_id=pay_id).pack())]])
@@ -0,0 +1,415 @@
+# End-to-end load test: the bot runs unchanged against fake Telegram Bot API and fake YooKassa on localhost
+# Every virtual user goes through the whole purchase: /start -> buy -> any country -> plan -> pay -> key
+# Cold start is measured too: import time, create_app() and time until bot answers first update
+#
+#   python loadtest.py --users 1000 --concurrency 200
+#
+# Database, keys and settings live in temporary folder, production files are never touched
+import config # Copy with fake servers and temporary files is passed to main.create_app()
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import tempfile
+import time
+import uuid
+
+import inventory # Key states
+
+from aiohttp import web
+
+# Pick free localhost port for fake servers
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Start aiohttp app on localhost, returns runner to clean it up later
+async def serve(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+# Percentile of sorted list
+def percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+# One Bot API request made by the bot
+class Call():
+    __slots__ = ('method', 'params', 'time')
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.time = time.perf_counter()
+
+# Fake Telegram Bot API: hands out scripted updates and records everything bot sends
+class FakeTelegram():
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        self.inbox = collections.defaultdict(asyncio.Queue) # chat_id -> calls made to this chat
+        self.calls = collections.Counter() # method -> count
+        self.polling = asyncio.Event() # Set on first getUpdates, bot is ready
+        self.first_answer = None # Time of first message sent by bot
+        self.key_messages = collections.Counter() # chat_id -> messages with new key
+
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    def user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'user{chat_id}'}
+
+    def message(self, chat_id, text=None, message_id=None):
+        if message_id is None:
+            self.message_id += 1
+            message_id = self.message_id
+
+        message = {'message_id': message_id,
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if text is not None:
+            message['text'] = text
+        return message
+
+    # Update with text message from user
+    def send_text(self, chat_id, text):
+        self.update_id += 1
+        message = self.message(chat_id, text)
+        message['from'] = self.user(chat_id)
+        self.updates.put_nowait({'update_id': self.update_id, 'message': message})
+
+    # Update with inline button tap
+    def send_callback(self, chat_id, data):
+        self.update_id += 1
+        self.updates.put_nowait({'update_id': self.update_id,
+                                 'callback_query': {'id': str(self.update_id),
+                                                    'from': self.user(chat_id),
+                                                    'chat_instance': str(chat_id),
+                                                    'message': self.message(chat_id, ''),
+                                                    'data': data}})
+
+    # Wait for call to chat that matches predicate, other calls to this chat are skipped
+    async def expect(self, chat_id, predicate, timeout):
+        inbox = self.inbox[chat_id]
+        deadline = time.perf_counter() + timeout
+
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                raise asyncio.TimeoutError
+
+            call = await asyncio.wait_for(inbox.get(), left)
+            if predicate(call):
+                return call
+
+    # Long polling: return as soon as there are updates or timeout passes
+    async def get_updates(self, params):
+        self.polling.set()
+
+        try:
+            first = await asyncio.wait_for(self.updates.get(), float(params.get('timeout') or 0) or 0.1)
+        except asyncio.TimeoutError:
+            return []
+
+        updates = [first]
+        while len(updates) < 100 and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == 'getUpdates':
+            result = await self.get_updates(params)
+
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            result = self.message(chat_id, params.get('text', ''))
+            if self.first_answer is None:
+                self.first_answer = time.perf_counter()
+            if 'Успешная оплата' in result['text']:
+                self.key_messages[chat_id] += 1
+            self.inbox[chat_id].put_nowait(Call(method, params))
+
+        elif method in ('editMessageReplyMarkup', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            result = self.message(chat_id, '', int(params['message_id']))
+            self.inbox[chat_id].put_nowait(Call(method, params))
+
+        # deleteMessage, answerCallbackQuery, deleteWebhook...
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+# Fake YooKassa API: payments are created pending and paid by the test when virtual user "pays"
+# Faults can be injected: slow answers and random server errors
+class FakeYooKassa():
+    def __init__(self, fail_rate=0, delay=0):
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.failed = 0
+        self.payments = {} # id -> payment object
+        self.keys = {} # Idempotence-Key -> payment id, repeated create returns same payment like real API
+        self.created = 0
+        self.lookups = 0
+
+        self.app = web.Application(middlewares=[self.faults])
+        self.app.router.add_post('/v3/payments', self.create)
+        self.app.router.add_get('/v3/payments/{id}', self.find)
+
+    @web.middleware
+    async def faults(self, request, handler):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self.failed += 1
+            return web.json_response({'type': 'error', 'code': 'internal_server_error'}, status=500)
+        return await handler(request)
+
+    def paid(self) -> int:
+        return sum(payment['status'] == 'succeeded' for payment in self.payments.values())
+
+    def pay(self, payment_id):
+        self.payments[payment_id]['status'] = 'succeeded'
+        self.payments[payment_id]['paid'] = True
+
+    async def create(self, request):
+        id_key = request.headers.get('Idempotence-Key')
+        if id_key in self.keys:
+            return web.json_response(self.payments[self.keys[id_key]])
+
+        body = await request.json()
+        payment_id = str(uuid.uuid4())
+        self.payments[payment_id] = {
+            'id': payment_id,
+            'status': 'pending',
+            'paid': False,
+            'amount': body['amount'],
+            'description': body.get('description', ''),
+            'metadata': body.get('metadata', {}),
+            'confirmation': {'type': 'redirect',
+                             'confirmation_url': f'https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}'},
+            'created_at': '2024-01-01T00:00:00.000Z',
+            'recipient': {'account_id': '1', 'gateway_id': '1'},
+            'refundable': False,
+            'test': True,
+        }
+        self.created += 1
+
+        if id_key:
+            self.keys[id_key] = payment_id
+        return web.json_response(self.payments[payment_id])
+
+    async def find(self, request):
+        self.lookups += 1
+        payment = self.payments.get(request.match_info['id'])
+        if payment is None:
+            return web.json_response({'type': 'error', 'code': 'not_found'}, status=404)
+        return web.json_response(payment)
+
+# Latency of every journey step and failed steps
+class Stats():
+    def __init__(self):
+        self.latency = collections.defaultdict(list) # step -> seconds
+        self.failed = collections.Counter() # step -> timeouts
+        self.unavailable = 0 # Journeys stopped by "payment system unavailable" answer
+        self.journeys = 0
+
+    # Every paid payment must get exactly one key: rows sold in inventory and key messages against paid payments
+    @staticmethod
+    def report_keys(tg, kassa, database):
+        with sqlite3.connect(database) as conn:
+            sold, payments = conn.execute("SELECT COUNT(*), COUNT(DISTINCT pay_id) FROM keys WHERE state=?",
+                                          (inventory.USED,)).fetchone()
+        conn.close()
+
+        paid = kassa.paid()
+        messages = sum(tg.key_messages.values())
+        print(f'\nPaid payments: {paid}, keys issued: {sold} for {payments} payments, key messages: {messages} '
+              f'to {len(tg.key_messages)} chats')
+        print(f'Paid without key: {paid - payments}, extra keys: {sold - payments}, '
+              f'chats with several key messages: {sum(count > 1 for count in tg.key_messages.values())}')
+
+    def report(self, elapsed, tg, kassa):
+        print(f'\nJourneys completed: {self.journeys} in {elapsed:.1f}s ({self.journeys / elapsed:.1f}/s)')
+        print(f'Updates sent: {tg.update_id} ({tg.update_id / elapsed:.1f}/s)')
+        print(f'Bot API calls: {dict(tg.calls)}')
+        print(f'Payments created: {kassa.created}, status lookups: {kassa.lookups}, injected errors: {kassa.failed}')
+        print(f'Users told payments are unavailable: {self.unavailable}')
+        print(f'\n{"step":<12}{"count":>7}{"failed":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+
+        for step, values in self.latency.items():
+            values.sort()
+            print(f'{step:<12}{len(values):>7}{self.failed[step]:>8}'
+                  f'{percentile(values, 0.5) * 1000:>9.0f}{percentile(values, 0.95) * 1000:>9.0f}'
+                  f'{percentile(values, 0.99) * 1000:>9.0f}{values[-1] * 1000 if values else 0:>9.0f}')
+
+        for step in self.failed.keys() - self.latency.keys():
+            print(f'{step:<12}{0:>7}{self.failed[step]:>8}')
+
+        if self.journeys:
+            print(f'\nMean journey: {statistics.mean(self.latency["journey"]) * 1000:.0f} ms')
+
+# Reply markup from recorded call, bot sends it as JSON string in form data
+def reply_markup(call):
+    markup = call.params.get('reply_markup') or {}
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return markup
+
+# Callback data of the payment confirmation button
+def pay_button(call):
+    for row in reply_markup(call).get('inline_keyboard', []):
+        for button in row:
+            if (button.get('callback_data') or '').startswith('pay:'):
+                return button['callback_data']
+    return None
+
+# One virtual user buying a plan
+async def journey(tg, kassa, chat_id, plan, stats, timeout):
+    # Imported after config overrides
+    import catalog
+    import settings
+
+    texts = settings.current
+    started = time.perf_counter()
+
+    async def step(name, send, predicate):
+        start = time.perf_counter()
+        send()
+        try:
+            call = await tg.expect(chat_id, predicate, timeout)
+        except asyncio.TimeoutError:
+            stats.failed[name] += 1
+            raise
+        stats.latency[name].append(call.time - start)
+        return call
+
+    sent = lambda call: call.method == 'sendMessage'
+    unavailable = lambda call: sent(call) and call.params.get('text') == texts.PAYMENT_UNAVAILABLE
+
+    try:
+        await step('start', lambda: tg.send_text(chat_id, '/start'), sent)
+        await step('buy', lambda: tg.send_text(chat_id, texts.BUY), sent)
+        await step('country', lambda: tg.send_text(chat_id, texts.ANY_COUNTRY),
+                   lambda call: sent(call) and 'plan:' in json.dumps(reply_markup(call)))
+
+        plan_data = catalog.PlanCallback(country=catalog.ANY_COUNTRY, plan=plan).pack()
+        order = await step('order', lambda: tg.send_callback(chat_id, plan_data),
+                           lambda call: (sent(call) and pay_button(call)) or unavailable(call))
+        if unavailable(order):
+            stats.unavailable += 1
+            return
+
+        # User pays on YooKassa page and taps confirmation
+        pay_data = pay_button(order)
+        kassa.pay(pay_data.split(':', 1)[1])
+        paid = await step('pay', lambda: tg.send_callback(chat_id, pay_data),
+                          lambda call: (sent(call) and 'Ваш ключ' in call.params.get('text', '')) or unavailable(call))
+        if unavailable(paid):
+            stats.unavailable += 1
+            return
+
+    except asyncio.TimeoutError:
+        return
+
+    stats.latency['journey'].append(time.perf_counter() - started)
+    stats.journeys += 1
+
+async def run(args):
+    folder = tempfile.mkdtemp(prefix='loadtest-')
+    tg, kassa = FakeTelegram(), FakeYooKassa(args.fail_rate, args.kassa_delay)
+    tg_port, kassa_port = free_port(), free_port()
+
+    # Point bot to fake servers and temporary files, config module itself stays untouched
+    conf = config.override(TOKEN='123456:LOADTEST',
+                           TELEGRAM_API_URL=f'http://127.0.0.1:{tg_port}',
+                           YOOKASSA_API_URL=f'http://127.0.0.1:{kassa_port}/v3',
+                           DATABASE=os.path.join(folder, 'loadtest.db'),
+                           KEYS_FOLDER=os.path.join(folder, 'keys'),
+                           SETTINGS_FILE=os.path.join(folder, 'settings.json'),
+                           YOOKASSA_WEBHOOK_HOST='127.0.0.1',
+                           YOOKASSA_WEBHOOK_PORT=free_port(),
+                           PAYMENT_POLL_INTERVAL=args.poll_interval,
+                           SEND_GLOBAL_RATE=args.send_rate or config.SEND_GLOBAL_RATE)
+
+    # Enough keys for every virtual user
+    os.makedirs(conf.KEYS_FOLDER)
+    with open(os.path.join(conf.KEYS_FOLDER, 'any_country.txt'), 'w') as file:
+        file.write('\n'.join(f'vless://loadtest-{i}' for i in range(args.users)))
+
+    runners = [await serve(tg.app, tg_port), await serve(kassa.app, kassa_port)]
+
+    # Cold start: import, app factory, startup until first getUpdates and until first answer
+    launched = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    main.create_app(conf)
+    created = time.perf_counter()
+
+    bot = asyncio.create_task(main.main())
+    await asyncio.wait_for(tg.polling.wait(), 30)
+    ready = time.perf_counter()
+
+    print(f'Startup: import main {(imported - launched) * 1000:.0f} ms, create_app {(created - imported) * 1000:.0f} ms, '
+          f'ready for updates {(ready - launched) * 1000:.0f} ms')
+    print(f'Running {args.users} users with concurrency {args.concurrency}')
+
+    stats = Stats()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def user(chat_id):
+        async with slots:
+            await journey(tg, kassa, chat_id, args.plan, stats, args.timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1000000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await main.dp.stop_polling()
+    await bot
+    for runner in runners:
+        await runner.cleanup()
+
+    stats.report(elapsed, tg, kassa)
+    stats.report_keys(tg, kassa, conf.DATABASE)
+    if tg.first_answer:
+        print(f'Time to first answer: {(tg.first_answer - launched) * 1000:.0f} ms after launch')
+    print(f'\nTemporary files: {folder}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end load test against fake Telegram and YooKassa')
+    parser.add_argument('--users', type=int, default=200, help='Virtual users, each makes one purchase')
+    parser.add_argument('--concurrency', type=int, default=50, help='Users going through the funnel at the same time')
+    parser.add_argument('--plan', default='one_day')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for bot answer on every step')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='Pause before payment status check')
+    parser.add_argument('--send-rate', type=float, default=None, help='Override global outbound rate (messages per second)')
+    parser.add_argument('--fail-rate', type=float, default=0, help='Share of YooKassa requests answered with server error')
+    parser.add_argument('--kassa-delay', type=float, default=0, help='Seconds fake YooKassa waits before every answer')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(run(args))
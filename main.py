@@ -2,393 +2,501 @@
 import config # Config with all bot data
 import logging
 import asyncio
-import sqlite3 # Database
 import datetime
 import os
+import tempfile
 import payment # Payment API
+import settlement # Payment settlement pipeline
+import inventory # VPN keys storage
+import sessions # User sessions cache
+import storage # Async database access
+import migrations # Database schema
+import keyboards # Prebuilt keyboards
+import catalog # Plans and countries
+import settings # Reloadable prices and texts
+import metrics # Prometheus metrics
+import monitoring # Handler metrics and /metrics endpoint
+import sender as outbound # Outbound messages queue
+import orders as orders_store # Pending orders
+import reminders as reminders_store # Scheduled reminders
+import admin # Inventory admin tool
+import throttling # Anti-flood limits
 
 # Bot lib
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import Bot, Dispatcher, Router, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramForbiddenError
+from aiohttp import web
 
 # StateFilter
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.types import ReplyKeyboardRemove
-from aiogram.types import CallbackQuery
+from aiogram.types import CallbackQuery, FSInputFile
+from aiogram.methods import SendDocument
 
 from aiogram.types.message import ContentType
 
 # For debugging
 logging.basicConfig(level=logging.INFO)
 
-# Create bot object with TOKEN
-bot = Bot(token=config.TOKEN,
-          parse_mode='HTML')
-
-# Create dispatcher, database and initialise database cursor
-dp = Dispatcher()
-db = sqlite3.connect('user-data.db') # Connect database
-c = db.cursor()
-
-# Buttons
-buy = config.BUY
-subscriptions = config.SUBSCRIPTIONS
-reviews = config.REVIEWS
-support = config.SUPPORT
-any_country = config.ANY_COUNTRY
-countries = config.COUNTRIES
+# Bot API session, points to local Bot API server (or fake one in load test) when configured
+def create_session(api_url=None):
+    if not api_url:
+        return None
+
+    return AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+
+# Handlers are registered on router, dispatcher is created by create_app()
+router = Router()
+
+# Config given to create_app(), config module unless load test or benchmark passes config.override() copy
+conf = config
+
+# Bot, dispatcher, database, inventory, sessions, sender and settlement pipeline, created by create_app()
+# Nothing is opened or connected until they are used, so importing this module is cheap
+bot = None
+dp = None
+db = None
+orders = None
+reminders = None
+keys = None
+sender = None
+payment_settlement = None
+payment_links = None
+user_data_list = None
+
+# Keyboards and texts, replaced by refresh_interface() and on settings reload (prepare_interface())
+ui = None
+
+# Free keys per country are read on every scrape
+metrics.Gauge('bot_keys_available', 'Free VPN keys', ('country',),
+              collect=lambda: {(country,): keys.available(country) for country in settings.current.key_countries} if keys else {})
+
+# Build everything bot needs from app_conf, returns dispatcher
+# Run modes and handlers read the same config afterwards, so nothing has to be changed in config module
+def create_app(app_conf=config):
+    global conf, bot, dp, db, orders, reminders, keys, sender, payment_settlement, payment_links, user_data_list, ui
+    conf = app_conf
+
+    # YooKassa SDK is imported and configured on first payment
+    payment.configure(conf)
+
+    # Settings file may differ from the one loaded on import
+    settings.current = settings.load(conf.SETTINGS_FILE)
+
+    # Create bot object with TOKEN
+    bot = Bot(token=conf.TOKEN,
+              session=create_session(conf.TELEGRAM_API_URL),
+              parse_mode='HTML')
+
+    # Create dispatcher with all handlers
+    dp = Dispatcher()
+    dp.include_router(router)
+
+    # Anti-flood limits run before filters, dropped updates cost almost nothing
+    # One instance for both update types, so chat has one state
+    limits = throttling.ThrottlingMiddleware({throttling.MENU: (conf.THROTTLE_MENU_RATE, conf.THROTTLE_MENU_BURST),
+                                              throttling.PAYMENT: (conf.THROTTLE_PAYMENT_RATE, conf.THROTTLE_PAYMENT_BURST)},
+                                             conf.THROTTLE_DEBOUNCE,
+                                             conf.THROTTLE_MAX_CHATS,
+                                             conf.THROTTLE_IDLE,
+                                             exempt=conf.ADMINS)
+    dp.message.outer_middleware(limits)
+    dp.callback_query.outer_middleware(limits)
+
+    # Handlers latency and errors
+    dp.message.middleware(monitoring.HandlerMetricsMiddleware())
+    dp.callback_query.middleware(monitoring.HandlerMetricsMiddleware())
+
+    # Database threads start on first query
+    db = storage.Storage(conf.DATABASE, conf.DB_BATCH_SIZE, conf.DB_FLUSH_INTERVAL)
+
+    # Created payments waiting for settlement
+    orders = orders_store.Orders(db,
+                                 conf.ORDERS_BATCH_SIZE,
+                                 conf.ORDERS_BASE_DELAY,
+                                 conf.ORDERS_MAX_DELAY,
+                                 conf.ORDERS_TTL)
+
+    # Renewal reminders and unpaid order nudges
+    reminders = reminders_store.Reminders(db,
+                                          conf.REMINDERS_BATCH_SIZE,
+                                          conf.REMIND_BEFORE,
+                                          conf.NUDGE_AFTER)
+
+    # VPN keys inventory (filled from keys/*.txt on start), connected on first use
+    keys = inventory.KeyInventory(conf.DATABASE)
+
+    # All messages to users are sent through rate limited queue
+    sender = outbound.Sender(bot,
+                             conf.SEND_GLOBAL_RATE,
+                             conf.SEND_CHAT_RATE,
+                             conf.SEND_CHAT_BURST,
+                             conf.SEND_WORKERS,
+                             conf.SEND_MAX_RETRIES)
+
+    # Settlement pipeline shared by confirmation button and YooKassa notifications
+    payment_settlement = settlement.Settlement(settle_payment,
+                                               lambda pay_id: keys.run(keys.issued, pay_id),
+                                               conf.SETTLEMENT_WORKERS,
+                                               conf.SETTLED_CACHE_SIZE)
+
+    # Unpaid payment links, repeated plan taps reuse them
+    payment_links = payment.PaymentLinks(conf.PAYMENT_LINK_TTL, conf.PAYMENT_LINKS_SIZE)
+
+    # For storing personal user data, old and idle users are evicted
+    user_data_list = sessions.SessionCache(UserData,
+                                           conf.SESSION_CACHE_SIZE,
+                                           conf.SESSION_TTL,
+                                           conf.SESSION_PURCHASE_TTL)
+
+    ui = keyboards.Interface(settings.current)
+
+    return dp
 
 # Personal user data
 class UserData():
+    # Slots keep each cached user small
+    __slots__ = ('user_id', 'question_message', 'country', 'title', 'subscriped')
+
     def __init__(self, user_id):
-        self.subscriped = []
+        self.subscriped = None # Loaded from database on first use
         self.user_id = user_id
         self.question_message = None
         self.country = None
         self.title = None
 
-    def save_subscription_to_db(self):
-        c.execute("DELETE FROM subscriptions WHERE user_id=?", (self.user_id,))
-        for sub in self.subscriped:
-            c.execute('INSERT INTO subscriptions (user_id, offer, key) VALUES (?, ?, ?)',
-                      (self.user_id, sub["offer"], sub["key"]))
-            db.commit()
+    # Get subscriptions, loading them from database if needed or asked to reload
+    async def subscriptions(self, reload=False):
+        if reload or self.subscriped is None:
+            self.subscriped = await UserData.load_subscription_from_db(self.user_id)
+        return self.subscriped
 
+    # New purchase is already stored with the key claim (purchase_record()), keep cached list in sync if it was loaded
+    def add_subscription(self, offer, key):
+        if self.subscriped is not None:
+            self.subscriped.append({"offer": offer, "key": key})
+
+    # Expired subscriptions are not shown, old ones without expiry date are
     @staticmethod
-    def load_subscription_from_db(user_id):
-        c.execute("SELECT offer, key FROM subscriptions WHERE user_id=?", (user_id,))
-        subscriped = [{"offer": row[0], "key": row[1]} for row in c.fetchall()]
+    async def load_subscription_from_db(user_id):
+        rows = await db.fetchall("SELECT offer, key FROM subscriptions WHERE user_id=? AND (expires_at IS NULL OR expires_at>?)",
+                                 (user_id, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        subscriped = [{"offer": row[0], "key": row[1]} for row in rows]
         return subscriped
-    
-# For storing user id
-user_data_list = {}
 
 # Initialise '/start' command
-@dp.message(Command(commands=['start']))
+@router.message(Command(commands=['start']))
 async def start_handler(msg: types.Message):
 
     # If user id not in list, append
     user_id = msg.chat.id
     if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
-        user_data_list[user_id].subscriped = UserData.load_subscription_from_db(user_id)
+        user_data_list.get(user_id)
 
-        # Check, if value in this table already exists
-        c.execute("SELECT * FROM potential_customers WHERE username=?", (msg.from_user.username,))
-        data = c.fetchone()
+        # Append user into SQL table, existing user only gets fresh username
+        await db.execute('''INSERT INTO potential_customers (user_id, username, date) VALUES(?, ?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET username=excluded.username''',
+                         (msg.from_user.id, msg.from_user.username, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
-        if data is None:
-            # Append user into SQL table
-            c.execute("INSERT INTO potential_customers VALUES(?, ?)", (msg.from_user.username, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            db.commit()
+    metrics.funnel.inc('start')
 
-    # Get bot info
-    bot_info = await bot.get_me()
-
-    # Prepare buttons
-    kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=buy), KeyboardButton(text=subscriptions)], 
-                                       [KeyboardButton(text=reviews), KeyboardButton(text=support)]],
-                             resize_keyboard=True)
-    
     # Greetings to user with keyboard
-    await bot.send_message(msg.chat.id, 
-                           f"👋 Добро пожаловать в бота {bot_info.full_name}\n\n🚀 Здесь ты можешь оформить и пользоваться нашим VPN 24/7 без ограничений",
-                           reply_markup=kb)
+    await sender.send_message(msg.chat.id, 
+                              ui.welcome,
+                              reply_markup=ui.menu)
 
 # Buy button handler
-@dp.message(lambda msg: msg.text == buy)
+@router.message(lambda msg: msg.text == settings.current.BUY)
 async def buy_clicked(msg: types.Message):
-    # If user id not in list, append
-    user_id = msg.chat.id
-    if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
+    # Register user in sessions cache
+    user_data_list.get(msg.chat.id)
+
+    metrics.funnel.inc('buy')
 
-    # Prepare new interaction keyboard
-    kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=any_country), KeyboardButton(text=countries)]],
-                             resize_keyboard=True)
-    
     # Send question about country
-    await bot.send_message(msg.chat.id,
-                           config.WHICH_COUNTRY,
-                           reply_markup=kb)
+    await sender.send_message(msg.chat.id,
+                              settings.current.WHICH_COUNTRY,
+                              reply_markup=ui.country_type)
 
 # Any countries handler
-@dp.message(lambda msg: msg.text == any_country)
+@router.message(lambda msg: msg.text == settings.current.ANY_COUNTRY)
 async def any_country_clicked(msg: types.Message):
-    # If not in list, append
-    user_id = msg.chat.id
-    if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
-        user_data_list[user_id].subscriped = UserData.load_subscription_from_db(user_id)
-    
-    # Get personal info using personal user class
-    user_data = user_data_list[msg.chat.id]
+    # Get personal user data, it's created if user is new
+    user_data = user_data_list.get(msg.chat.id)
 
     # Set country as any and propose the plan
-    user_data.country = 'any_country'
-    await propose_plan(msg)
+    user_data.country = catalog.ANY_COUNTRY
+    await propose_plan(msg, catalog.ANY_COUNTRY)
 
 # Countries handler
-@dp.message(lambda msg: msg.text == countries)
+@router.message(lambda msg: msg.text == settings.current.COUNTRIES)
 async def countries_clicked(msg: types.Message):
-    # If user not in the list, append id
-    user_id = msg.chat.id
-    if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
-        user_data_list[user_id].subscriped = UserData.load_subscription_from_db(user_id)
+    # Register user in sessions cache
+    user_data_list.get(msg.chat.id)
         
-    # Prepare new interaction keyboard with available countries
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Германия 🇩🇪', callback_data='germany')], 
-                                                [InlineKeyboardButton(text='Финляндия 🇫🇮', callback_data='finland')],
-                                                [InlineKeyboardButton(text='Швейцария 🇨🇭', callback_data='switz')],
-                                                [InlineKeyboardButton(text='Турция 🇹🇷', callback_data='turkey')]])    
-    
     # Propose this countries
-    await bot.send_message(msg.chat.id,
-                           config.WHICH_COUNTRY,
-                           reply_markup=kb)
+    await sender.send_message(msg.chat.id,
+                              settings.current.WHICH_COUNTRY,
+                              reply_markup=ui.countries)
     
 # Other buttons handlers   
-@dp.message(lambda msg: msg.text == subscriptions)
+@router.message(lambda msg: msg.text == settings.current.SUBSCRIPTIONS)
 async def subs_clicked(msg: types.Message):
-    # If user not in the list, append
-    if msg.chat.id not in user_data_list:
-        user_data_list[msg.chat.id] = UserData(msg.chat.id)
-        user_data_list[msg.chat.id].subscriped = UserData.load_subscription_from_db(msg.chat.id)
-
-    # Get personal user data
-    user_data = user_data_list[msg.chat.id] 
+    # Get personal user data, it's created if user is new
+    user_data = user_data_list.get(msg.chat.id)
 
     # If user don't have any subscriptions send warning message
-    if not user_data.subscriped:
-        await bot.send_message(msg.chat.id, config.SUB_ERR)
+    # Always read from database, purchase could be settled by another worker
+    subscriped = await user_data.subscriptions(reload=True)
+    if not subscriped:
+        await sender.send_message(msg.chat.id, settings.current.SUB_ERR)
 
     # Otherwise get all subscription list
     else:
-        text = '\n'.join([f'<b>{sub["offer"]}</b> - <code>{sub["key"]}</code>' for sub in user_data.subscriped])
-        await bot.send_message(msg.chat.id,
-                               f'<b>Текущие подписки:</b>\n\n{text}')
+        text = '\n'.join([f'<b>{sub["offer"]}</b> - <code>{sub["key"]}</code>' for sub in subscriped])
+        await sender.send_message(msg.chat.id,
+                                  f'<b>Текущие подписки:</b>\n\n{text}')
 
 # Reviews button handler      
-@dp.message(lambda msg: msg.text == reviews)
+@router.message(lambda msg: msg.text == settings.current.REVIEWS)
 async def review_clicked(msg: types.Message):
-    # If user not in the list, append
-    user_id = msg.chat.id
-    if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
-
-    # Get bot info
-    bot_info = await bot.get_me()
+    # Register user in sessions cache
+    user_data_list.get(msg.chat.id)
 
     # Send user information about reviews
-    await bot.send_message(msg.chat.id,
-                           f'⭐️ Отзывы {bot_info.full_name}: https://t.me/kvpnchat')
+    await sender.send_message(msg.chat.id,
+                              ui.reviews)
 
 # Support button handler
-@dp.message(lambda msg: msg.text == support)
+@router.message(lambda msg: msg.text == settings.current.SUPPORT)
 async def support_clicked(msg: types.Message):
     # Send message about support
-    await bot.send_message(msg.chat.id,
-                           config.SUPPORT_INFO)
+    await sender.send_message(msg.chat.id,
+                              settings.current.SUPPORT_INFO)
+
+# Admin jobs run in a thread with their own inventory connection, so bot keeps answering during big imports
+async def inventory_job(func, *args):
+    def job():
+        admin_keys = inventory.KeyInventory(conf.DATABASE)
+        try:
+            return func(admin_keys, *args)
+        finally:
+            admin_keys.close()
+
+    result = await asyncio.to_thread(job)
+
+    # Counters changed by another connection
+    await keys.run(keys.refresh)
+    return result
+
+# Admin commands, only for chats from ADMINS of config given to create_app()
+is_admin = F.from_user.id.func(lambda user_id: user_id in conf.ADMINS)
+
+# Stock and sell-through per country
+@router.message(Command(commands=['stock']), is_admin)
+async def stock_command(msg: types.Message):
+    report = await inventory_job(inventory.KeyInventory.report, conf.ADMIN_REPORT_DAYS)
+    await sender.send_message(msg.chat.id,
+                              f'<pre>{admin.format_report(report, conf.ADMIN_REPORT_DAYS)}</pre>')
+
+# Sales as CSV file, /export 2024-01-31 exports sales since that date
+@router.message(Command(commands=['export']), is_admin)
+async def export_command(msg: types.Message):
+    since = msg.text.split(maxsplit=1)[1].strip() if ' ' in msg.text else None
+    handle, path = tempfile.mkstemp(prefix='sales-', suffix='.csv')
+    os.close(handle)
+
+    try:
+        count = await inventory_job(inventory.KeyInventory.export_sales, path, since)
+        await sender.call(SendDocument(chat_id=msg.chat.id,
+                                       document=FSInputFile(path, filename='sales.csv'),
+                                       caption=f'Продаж: {count}'))
+    finally:
+        os.remove(path)
+
+# Archive used_*.txt and drop sold keys from keys files
+@router.message(Command(commands=['compact']), is_admin)
+async def compact_command(msg: types.Message):
+    countries = sorted(set(settings.current.key_countries) | set(admin.file_countries(conf.KEYS_FOLDER)))
+    compacted = await inventory_job(inventory.KeyInventory.compact_files, conf.KEYS_FOLDER, countries, conf.KEYS_ARCHIVE)
+
+    text = '\n'.join(f'{country}: в архиве {archived}, убрано проданных {removed}' for country, (archived, removed) in compacted.items())
+    await sender.send_message(msg.chat.id, text or 'Нет файлов с ключами')
+
+# Text file with keys sent with caption "/import country" (Telegram lets bots download files up to 20 MB, use admin.py for bigger)
+@router.message(F.document, F.caption.startswith('/import'), is_admin)
+async def import_command(msg: types.Message):
+    parts = msg.caption.split()
+    if len(parts) != 2 or parts[1] not in settings.current.key_countries:
+        await sender.send_message(msg.chat.id, f'Формат: /import страна, страны: {", ".join(settings.current.key_countries)}')
+        return
+
+    handle, path = tempfile.mkstemp(prefix='keys-', suffix='.txt')
+    os.close(handle)
+
+    try:
+        await bot.download(msg.document, destination=path)
+        added = await inventory_job(inventory.KeyInventory.add, parts[1], inventory.read_keys(path))
+    finally:
+        os.remove(path)
+
+    await sender.send_message(msg.chat.id, f'Добавлено ключей: {added}, свободно: {keys.available(parts[1])}')
+
+# Plan button: one purchase path for every plan from catalog
+async def plan_clicked(callback, user_data, callback_data):
+    plan = settings.current.plans.get(callback_data.plan)
+    country = callback_data.country
+    if plan is None or country not in settings.current.key_countries:
+        return
+
+    if check_files(country):
+        user_id = callback.message.chat.id
+
+        # Same plan tapped again: offer payment created a moment ago
+        link_key = (user_id, country, plan.id, plan.price)
+        link = payment_links.get(link_key)
+
+        if link:
+            pay_url, pay_id = link
+        else:
+            try:
+                pay_url, pay_id = await payment.create(plan.price,
+                                                       user_id,
+                                                       f"Покупка {plan.title} (до {get_term_info(plan.days)})",
+                                                       metadata=purchase_metadata(callback, country, plan))
+            except payment.PaymentUnavailable as e:
+                logging.warning("Payment for %s not created: %s", user_id, e)
+                await sender.send_message(user_id, settings.current.PAYMENT_UNAVAILABLE)
+                return
+
+            payment_links.put(link_key, pay_url, pay_id)
+
+            # Keep order in database, it will be settled even if user never taps confirmation
+            await orders.create(pay_id, user_id, callback.from_user.username, plan, country, plan.price)
+            metrics.funnel.inc('order')
+
+        # Country and plan are kept in order and payment metadata now, session doesn't have to be pinned
+        user_data.country = None
+        user_data.title = None
+
+        await sender.send_message(user_id,
+                                  f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
+                                  reply_markup=keyboards.order(pay_url, pay_id))
+
+    else:
+        await sender.send_message(callback.message.chat.id,
+                                  settings.current.PAYMENT_ERROR)
+
+# Payment confirmation button
+async def payment_clicked(callback, user_data, callback_data):
+    # Repeated and concurrent taps don't check payment again and never issue second key
+    try:
+        key, issued_now, paid, owner = await payment_settlement.confirm(callback_data.pay_id, payment.check)
+    except payment.PaymentUnavailable as e:
+        logging.warning("Payment %s not checked: %s", callback_data.pay_id, e)
+        await sender.send_message(callback.message.chat.id, settings.current.PAYMENT_UNAVAILABLE)
+        return
+
+    # Tap coalesced with the running one, first tap answers
+    if not owner:
+        return
+
+    # Check returned nothing: payment is not paid (yet), link stays offered until it expires
+    if not paid:
+        await sender.send_message(callback.message.chat.id, 'Оплата не прошла. Попробуйте ещё раз! 😕')
+
+    # Paid, but there was no free key, order stays pending and reconciliation issues key after refill
+    elif key is None:
+        payment_links.drop(callback_data.pay_id)
+        await sender.send_message(callback.message.chat.id, settings.current.PAYMENT_NO_STOCK)
+
+    # Payment was settled earlier, remind the key
+    elif not issued_now:
+        await sender.send_message(callback.message.chat.id, f'✅ Этот заказ уже оплачен.\n\nВаш ключ: <code>{key}</code>')
+
+# Country button, each country will be stored in user data class
+async def country_clicked(callback, user_data, callback_data):
+    if callback_data.country in settings.current.countries:
+        user_data.country = callback_data.country
+        await propose_plan(callback.message, callback_data.country)
+
+# If callback is menu, go to the menu
+async def menu_clicked(callback, user_data, callback_data):
+    await sender.send_message(callback.message.chat.id,
+                              settings.current.BACK_TO_MENU,
+                              reply_markup=ui.menu)
+
+# Callbacks for reminder
+async def reminder_yes_clicked(callback, user_data, callback_data):
+    # If user have problems send support contact
+    await support_clicked(callback.message)
+    await sender.delete_message(callback.message.chat.id, callback.message.message_id)
+
+async def reminder_no_clicked(callback, user_data, callback_data):
+    # If everything okay, just delete the message
+    await sender.delete_message(callback.message.chat.id, callback.message.message_id)
+
+# Callback prefix -> (callback data factory or None for plain callbacks, handler)
+callback_routes = {
+    catalog.PlanCallback.__prefix__: (catalog.PlanCallback, plan_clicked),
+    catalog.CountryCallback.__prefix__: (catalog.CountryCallback, country_clicked),
+    catalog.PaymentCallback.__prefix__: (catalog.PaymentCallback, payment_clicked),
+    'menu': (None, menu_clicked),
+    'yes': (None, reminder_yes_clicked),
+    'no': (None, reminder_no_clicked),
+}
 
 # Callbacks handler
-@dp.callback_query(lambda d: d.data)
+@router.callback_query(lambda d: d.data)
 async def callbacks_handler(callback: CallbackQuery):
-    # If user id not in the list, append
-    user_id = callback.message.chat.id
-    if user_id not in user_data_list:
-        user_data_list[user_id] = UserData(user_id)
+    # Get personal user data, it's created if user is new
+    user_data = user_data_list.get(callback.message.chat.id)
 
-    # Get user data
-    user_data = user_data_list[callback.message.chat.id]
+    # Confirmation buttons sent before structured callbacks
+    if callback.data.startswith('success_payment_'):
+        callback_data = catalog.PaymentCallback(pay_id=callback.data[len('success_payment_'):])
+        await payment_clicked(callback, user_data, callback_data)
+        return
 
-    # If subscription callback with term, send offer using function below the code
-    if callback.data == "one_day":
-        if await check_files(callback.message):
+    # Find handler by prefix in one lookup
+    route = callback_routes.get(callback.data.split(':', 1)[0])
+    if route is None:
+        return
 
-            pay_url, pay_id = payment.create(config.ONE_DAY,
-                                            user_id, 
-                                            f"Покупка VPN на 1 день (до {get_term_info(1)})")
+    factory, handler = route
+    try:
+        callback_data = factory.unpack(callback.data) if factory else None
+    except (TypeError, ValueError):
+        return
 
-            user_data.title = 'VPN на 1 день'
-
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url, callback_data=''), InlineKeyboardButton(text='Подтвердить оплату', callback_data=f'success_payment_{pay_id}')]])
-            
-            await bot.send_message(user_id, 
-                                f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
-                                reply_markup=kb)
-
-        else:
-            await bot.send_message(callback.message.chat.id,
-                        config.PAYMENT_ERROR)
-
-    elif callback.data == "one_month":
-        if await check_files(callback.message):
-            pay_url, pay_id = payment.create(config.ONE_MONTH,
-                                            user_id, 
-                                            f"Покупка VPN на 1 месяц (до {get_term_info(30)})")
-            
-            user_data.title = 'VPN на 1 месяц'
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url, callback_data=''), InlineKeyboardButton(text='Подтвердить оплату', callback_data=f'success_payment_{pay_id}')]])
-            
-            await bot.send_message(user_id, 
-                                f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
-                                reply_markup=kb)
-            
-        else:
-            await bot.send_message(callback.message.chat.id,
-                        config.PAYMENT_ERROR)
-
-    elif callback.data == "three_month":
-        if await check_files(callback.message):
-
-            pay_url, pay_id = payment.create(config.THREE_MONTH,
-                                        user_id, 
-                                        f"Покупка VPN на 3 месяца (до {get_term_info(90)})")
-            
-            user_data.title = 'VPN на 3 месяца'
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url, callback_data=''), InlineKeyboardButton(text='Подтвердить оплату', callback_data=f'success_payment_{pay_id}')]])
-            
-            await bot.send_message(user_id, 
-                                f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
-                                reply_markup=kb)
-            
-        else:
-            await bot.send_message(callback.message.chat.id,
-                        config.PAYMENT_ERROR)
-
-    elif callback.data == "six_month":
-        if await check_files(callback.message):
-
-            pay_url, pay_id = payment.create(config.SIX_MONTH,
-                                        user_id, 
-                                        f"Покупка VPN на 6 месяцев (до {get_term_info(180)})")
-            
-            user_data.title = 'VPN на 6 месяцев'
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url, callback_data=''), InlineKeyboardButton(text='Подтвердить оплату', callback_data=f'success_payment_{pay_id}')]])
-            
-            await bot.send_message(user_id, 
-                                f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
-                                reply_markup=kb)
-            
-        else:
-            await bot.send_message(callback.message.chat.id,
-                                   config.PAYMENT_ERROR)
-            
-    elif callback.data == "year":
-        if await check_files(callback.message):
-            pay_url, pay_id = payment.create(config.YEAR,
-                                        user_id, 
-                                        f"Покупка VPN на 12 месяцев (до {get_term_info(360)})")
-            
-            user_data.title = 'VPN на 12 месяцев'
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Перейти к оплате', url=pay_url, callback_data=''), InlineKeyboardButton(text='Подтвердить оплату', callback_data=f'success_payment_{pay_id}')]])
-            
-            await bot.send_message(user_id, 
-                                f"Ваш номер заказа: <b>{pay_id.strip()}</b>",
-                                reply_markup=kb)
-            
-        else:
-            await bot.send_message(callback.message.chat.id,
-                                   config.PAYMENT_ERROR)
-
-    elif "success_payment" in callback.data:
-        result = payment.check(callback.data.split('_')[-1])
-
-        if result:
-            if user_data.country == "germany":
-                await invoice_handler(callback, user_data, "germany", "used_germany")
-            elif user_data.country == "finland":
-                await invoice_handler(callback, user_data, "finland", "used_finland")
-            elif user_data.country == "switz":
-                await invoice_handler(callback, user_data, "switz", "used_switz")
-            elif user_data.country == "turkey":
-                await invoice_handler(callback, user_data, "turkey", "used_turkey")
-            else:
-                await invoice_handler(callback, user_data, "any_country", "used_any_country")
-
-        else:
-            await callback.message.answer('Оплата не прошла. Попробуйте ещё раз! 😕')
-                
-    # If callback is menu, create new keyboard and go to the menu 
-    elif callback.data == "menu":
-        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=buy), KeyboardButton(text=subscriptions)], 
-                                    [KeyboardButton(text=reviews), KeyboardButton(text=support)]],
-                            resize_keyboard=True)
-
-        sent_msg = await bot.send_message(callback.message.chat.id,
-                                    config.BACK_TO_MENU,
-                                    reply_markup=kb)
-    
-    # Callbacks for countries
-    # Each country will be stored in user data class
-    elif callback.data == "germany":
-        user_data.country = callback.data
-        await propose_plan(callback.message)
-    elif callback.data == "finland":
-        user_data.country = callback.data  
-        await propose_plan(callback.message)
-    elif callback.data == "switz":
-        user_data.country = callback.data
-        await propose_plan(callback.message)  
-    elif callback.data == "turkey":
-        user_data.country = callback.data  
-        await propose_plan(callback.message)
-
-    # Callbacks for reminder
-    elif callback.data == "yes":
-        # If user have problems send support contact
-        await support_clicked(callback.message)
-        await bot.delete_message(callback.message.chat.id, user_data.question_message)
-    elif callback.data == "no":
-        # If everything okay, just delete the message
-        await bot.delete_message(callback.message.chat.id, user_data.question_message)
+    await handler(callback, user_data, callback_data)
 
 # Checkout (must be here)
-# It checks if text file with keys exists
-@dp.pre_checkout_query(lambda query: True)
+# It checks if there are free keys for selected country
+@router.pre_checkout_query(lambda query: True)
 async def pre_check(precheck_q: types.PreCheckoutQuery):
     # Get user info
     user_id = precheck_q.from_user.id
-    user_data = user_data_list.get(user_id, None)
+    user_data = user_data_list.peek(user_id)
 
-    # Check if there's available txt files with keys
+    # Check if there's available keys in inventory
     if user_data:
         country = user_data.country
-        if country in ['germany', 'finland', 'switz', 'turkey', 'any_country']:
-            filename = f"keys/{country}.txt"
-            # If not txt file exists or it's empty, decline payment and notify about error
-            if not os.path.exists(filename) or os.path.getsize(filename) == 0:
-                await bot.answer_pre_checkout_query(precheck_q.id, ok=False, error_message=config.PAYMENT_ERROR)
+        if country in settings.current.key_countries:
+            # If there's no free keys, decline payment and notify about error
+            if not keys.available(country):
+                await bot.answer_pre_checkout_query(precheck_q.id, ok=False, error_message=settings.current.PAYMENT_ERROR)
+                return
     
-    # If there's available txt files, approve invoice
+    # If there's available keys, approve invoice
     await bot.answer_pre_checkout_query(precheck_q.id, ok=True)
 
-async def check_files(msg):
-    user_id = msg.chat.id
-    user_data = user_data_list.get(user_id, None)
-
-    if user_data:
-        country = user_data.country
-        if country in ['germany', 'finland', 'switz', 'turkey', 'any_country']:
-            filename = f"keys/{country}.txt"
-            # If not txt file exists or it's empty, decline payment and notify about error
-            if not os.path.exists(filename) or os.path.getsize(filename) == 0:
-                return False
-            
-    return True
+# Check if there are free keys for the country
+def check_files(country) -> bool:
+    return keys.available(country) > 0
 
 
-# Create a new table if its exist
-def create_sqltable(cursor, name, execution):
-    if not table_exists(cursor, name):
-        cursor.execute(execution)
-
-# Function that will check if table exists using sqlite_master
-def table_exists(cursor, table_name):
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-    return cursor.fetchone() is not None
-
 def get_term_info(days) -> str:
     # Current date
     current_date = datetime.datetime.now()
@@ -401,90 +509,324 @@ def get_term_info(days) -> str:
 
     return end_date_str
 
-# Scraping each txt file and send it to the user
-async def invoice_handler(callback, user_data, filename, used_filename):
-    # Find specific file to scrap
-    with open(f"keys/{filename}.txt", 'r') as file:
-        lines = file.readlines()
+# Build metadata that is stored in payment and used for settlement
+def purchase_metadata(callback, country, plan) -> dict:
+    return {'country': country,
+            'plan': plan.id,
+            'title': plan.title,
+            'days': plan.days,
+            'username': callback.from_user.username}
+
+# Term of purchased plan in days
+# Payments created before days were stored in metadata: find plan by id or title, None if it's unknown
+def plan_days(days, plan_id=None, title=None):
+    if days:
+        return int(days)
+
+    plan = settings.current.plans.get(plan_id)
+    if plan is None:
+        plan = next((plan for plan in settings.current.plans.values() if plan.title == title), None)
+
+    return plan.days if plan else None
+
+# Issue key for paid order, called once per payment by settlement pipeline
+# Returns (key, issued_now), key is None if there was no key, so payment is settled again later
+async def settle_payment(pay_id, metadata):
+    # YooKassa returns metadata values as strings
+    chat_id = int(metadata['chat_id'])
+    user_data = user_data_list.get(chat_id)
+
+    # Prefer data saved in payment, user could start another purchase meanwhile
+    country = metadata.get('country') or user_data.country
+    title = metadata.get('title') or user_data.title
+    days = plan_days(metadata.get('days'), metadata.get('plan'), title)
+
+    if country not in settings.current.key_countries:
+        country = catalog.ANY_COUNTRY
+
+    key, issued_now = await invoice_handler(pay_id, chat_id, metadata.get('username'), user_data, title, days, country)
+
+    # Order without key is marked paid and settled again by reconciliation when keys appear
+    if key is None:
+        await orders.mark_paid(pay_id)
+    else:
+        payment_links.drop(pay_id)
+        # Purchase is over, session goes back to normal TTL
+        user_data.country = None
+        user_data.title = None
+        await orders.set_status(pay_id, orders_store.SETTLED)
+
+    return key, issued_now
+
+# Subscription and customer rows of the purchase, written by inventory in the key claim transaction
+# Previous subscriptions are never rewritten
+# Unknown term (days=None) is stored without expiry date, such subscription is shown and never reminded
+def purchase_record(user_id, username, title, days):
+    def record(cur, key):
+        purchased_at = datetime.datetime.now()
+        expires_at = purchased_at + datetime.timedelta(days=days) if days else None
+
+        cur.execute('INSERT INTO subscriptions (user_id, offer, key, purchased_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, title, key,
+                     purchased_at.strftime("%Y-%m-%d %H:%M:%S"),
+                     expires_at.strftime("%Y-%m-%d %H:%M:%S") if expires_at else None))
+        cur.execute("INSERT INTO customers VALUES(?, ?, ?, ?)", (username,
+                                                                 purchased_at.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                 key,
+                                                                 title))
+    return record
+
+# Take next key from inventory and send it to the user
+# Returns (key, issued_now), issued_now is True when key was sent by this call
+async def invoice_handler(pay_id, chat_id, username, user_data, title, days, country):
+    # Claim key and store purchase atomically, so concurrent sales never get the same key and failed message loses nothing
+    # Payment settled earlier (maybe by another worker) gets delivered=True and nothing is sent again
+    key, issued_now, delivered = await keys.run(keys.claim, country, chat_id, username, pay_id,
+                                                purchase_record(chat_id, username, title, days))
+
+    if key is None or delivered:
+        return key, False
+
+    if issued_now:
+        metrics.funnel.inc('paid')
+        user_data.add_subscription(title, key)
+
+    # Key that wasn't delivered before (send failed, process died) is sent again
+    # Other send errors leave key undelivered, order stays pending and is settled again later
+    try:
+        # Notify about success payment
+        await sender.send_message(chat_id,
+                                  text=f'✅ Успешная оплата!\n\nВаш ключ: <code>{key}</code>',
+                                  priority=outbound.DELIVERY,
+                                  reply_markup=ui.menu)
 
-    # Delete file from the main file and put it into the txt file that contains used keys
-    if lines:
-        with open(f"keys/{used_filename}.txt", "a") as used_file:
-            used_file.write(lines[0])
+        # Then send tutorial explanation
+        await sender.send_message(chat_id,
+                                  text=settings.current.TUTORIAL,
+                                  priority=outbound.DELIVERY)
+    except TelegramForbiddenError:
+        # User blocked bot, retries won't help, key is in "Мои подписки" when user comes back
+        logging.warning("Key for payment %s not sent: chat %s blocked bot", pay_id, chat_id)
 
-        with open(f"keys/{filename}.txt", "w") as file:
-            file.writelines(lines[1:])
+    await keys.run(keys.mark_delivered, pay_id)
+    return key, True
 
-        # Divide key info
-        key = lines[0].strip()
+# Plan proposition
+async def propose_plan(msg, country):
+    # Confirm chosen country and remove previous keyboard, Telegram can't attach inline keyboard to the same message
+    chosen = settings.current.countries.get(country)
+    await sender.send_message(msg.chat.id,
+                              f'🌍 {chosen.title if chosen else settings.current.ANY_COUNTRY}',
+                              reply_markup=ui.remove)
+
+    await sender.send_message(msg.chat.id,
+                              settings.current.PROPOSE_PLAN,
+                              reply_markup=ui.plans[country])
+
+
+# Remind about subscription that is going to expire
+async def send_renewal(user_id, offer, expires_at):
+    date = datetime.datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%y")
+    await sender.send_message(user_id,
+                              settings.current.RENEWAL.format(offer=offer, date=date),
+                              priority=outbound.BULK,
+                              reply_markup=ui.menu)
+
+# Ask user who didn't pay for the order if there were problems
+async def send_nudge(chat_id):
+    sent_msg = await sender.send_message(chat_id,
+                                         settings.current.REMINDER,
+                                         priority=outbound.BULK,
+                                         reply_markup=ui.question)
+
+    user_data = user_data_list.peek(chat_id)
+    if user_data:
+        user_data.question_message = sent_msg.message_id
 
-        # Prepare keyboard
-        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=buy), KeyboardButton(text=subscriptions)], 
-                                            [KeyboardButton(text=reviews), KeyboardButton(text=support)]],
-                                    resize_keyboard=True)
+# Fetch bot identity once and rebuild cached keyboards and texts
+async def refresh_interface():
+    bot_info = await bot.get_me()
+    rebuild_interface(bot_info.full_name)
 
-        # Notify about success payment
-        await bot.send_message(callback.message.chat.id,
-                               text=f'✅ Успешная оплата!\n\nВаш ключ: <code>{key}</code>',
-                               reply_markup=kb)
-        
-        # Then send tutorial explanation
-        await bot.send_message(callback.message.chat.id,
-                               text=config.TUTORIAL)
-        
-        # Fill out subscription info to the personal user class
-        user_data.subscriped.append({"offer": user_data.title,
-                                "key": key})
+# Build new keyboards from current settings and swap them in one assignment
+def rebuild_interface(bot_name=None):
+    global ui
+    ui = keyboards.Interface(settings.current, ui.bot_name if bot_name is None else bot_name)
 
-        user_data.save_subscription_to_db()
+# Build keyboards for new settings before they are swapped in, returns function that swaps keyboards
+def prepare_interface(snapshot):
+    interface = keyboards.Interface(snapshot, ui.bot_name)
 
-        # Execute values into the SQL database
-        c.execute("INSERT INTO customers VALUES(?, ?, ?, ?)", (callback.from_user.username, 
-                                                               datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                               key,
-                                                               user_data.title))
-        # Commit changes
-        db.commit()
+    def apply():
+        global ui
+        ui = interface
 
-# Plan proposition
-async def propose_plan(msg):
-    # Send inline list with plans
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⭐ 1 день - 10 руб.", callback_data="one_day")], [InlineKeyboardButton(text="⭐ 1 месяц - 179 руб.", callback_data="one_month")],
-                                       [InlineKeyboardButton(text="⭐ 3 месяца - 460 руб. (-14%)", callback_data="three_month")], [InlineKeyboardButton(text="⭐ 6 месяц - 900 руб. (-16%)", callback_data="six_month")],
-                                       [InlineKeyboardButton(text="⭐ 12 месяцев - 1700 руб. (-20%)", callback_data="year")], [InlineKeyboardButton(text="👈 Меню", callback_data='menu')]])
-
-    # Remove previous keyboard
-    sent_msg = await bot.send_message(msg.chat.id,
-                           config.PROPOSE_PLAN,
-                           reply_markup=ReplyKeyboardRemove())
-    
-    await bot.delete_message(msg.chat.id, sent_msg.message_id)
-    
-    # And apply new one
-    await bot.send_message(msg.chat.id,
-                           config.PROPOSE_PLAN,
-                           reply_markup=kb)
+    return apply
+
+# Start everything bot needs besides updates source, returns background tasks to stop
+async def startup():
+    # Create or update sqltables
+    db.start()
+    await migrations.migrate(db)
+
+    # Load new keys from txt files into inventory and keep watching them
+    # Import runs in inventory thread, event loop stays free even for huge refills
+    logging.info("Imported keys: %s", await keys.run(keys.import_changed, conf.KEYS_FOLDER, settings.current.key_countries))
+    keys_watcher = asyncio.create_task(keys.watch(conf.KEYS_FOLDER, lambda: settings.current.key_countries, conf.KEYS_WATCH_INTERVAL))
+
+    # Warm up: bot name and keyboards are ready before first update
+    await refresh_interface()
+    sender.start()
+    payment_settlement.start()
+
+    # Settle paid orders in background
+    reconciler = asyncio.create_task(orders.reconcile(payment.status, payment_settlement.submit, conf.ORDERS_INTERVAL))
+
+    # Renewal reminders and nudges, sent with low priority
+    reminder = asyncio.create_task(reminders.run(send_renewal, send_nudge, conf.REMINDERS_INTERVAL))
+
+    # Prices, plans and texts are reloaded without restart, keyboards are rebuilt together with them
+    settings_watcher = asyncio.create_task(settings.watch(conf.SETTINGS_FILE, conf.SETTINGS_WATCH_INTERVAL, prepare_interface))
+
+    loop_lag = asyncio.create_task(metrics.watch_loop_lag(conf.LOOP_LAG_INTERVAL))
 
+    tasks = [keys_watcher, reconciler, reminder, settings_watcher, loop_lag]
 
+    # Optional sessions warm-up runs next to updates, so it never delays the first answer
+    if conf.SESSION_WARMUP:
+        tasks.append(asyncio.create_task(load_user_data(conf.SESSION_WARMUP)))
+
+    return tasks
+
+async def shutdown(tasks):
+    for task in tasks:
+        task.cancel()
+    await payment_settlement.stop()
+    await sender.stop()
+    await db.close()
+
+# Long polling mode, YooKassa notifications and metrics are served on their own port
 async def main():
-    # Create to sqltables if they exists
-    # - potential_customers: for storing information about potential customers that has already started communication with bot
-    # - customers: for storing information about customers that has already bought the plan
-    create_sqltable(c, "potential_customers", "CREATE TABLE potential_customers(username text, date text)")
-    create_sqltable(c, "customers", "CREATE TABLE customers(username text, date_purchase text, key text, term text)")
-    create_sqltable(c, "subscriptions", "CREATE TABLE subscriptions(user_id integer, offer text, key text)")
+    if dp is None:
+        create_app()
+    tasks = await startup()
 
-    # Start bot life
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    app = web.Application()
+    settlement.add_routes(app, payment_settlement, conf.YOOKASSA_WEBHOOK_PATH)
+    monitoring.add_routes(app, conf.METRICS_PATH)
 
-async def load_user_data():
-    c.execute("SELECT DISTINCT user_id FROM subscriptions")
-    user_ids = [row[0] for row in c.fetchall()]
-    for user_id in user_ids:
-        user_data = UserData(user_id)
-        user_data.subscriped = UserData.load_subscription_from_db(user_id)
-        user_data_list[user_id] = user_data
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, conf.YOOKASSA_WEBHOOK_HOST, conf.YOOKASSA_WEBHOOK_PORT).start()
+
+    # Start bot life
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await runner.cleanup()
+        await shutdown(tasks)
+
+# Webhook mode: Telegram updates and YooKassa notifications share one aiohttp server
+async def webhook_worker(workers):
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+    if dp is None:
+        create_app()
+    tasks = await startup()
+
+    # Telegram limits are for the whole bot, every process gets its share
+    sender.set_global_rate(conf.SEND_GLOBAL_RATE / workers)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=conf.WEBHOOK_SECRET).register(app, path=conf.WEBHOOK_PATH)
+    settlement.add_routes(app, payment_settlement, conf.YOOKASSA_WEBHOOK_PATH)
+    # Every worker has its own metrics, scrape with worker count in mind
+    monitoring.add_routes(app, conf.METRICS_PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port lets several processes listen on the same port, kernel balances connections
+    await web.TCPSite(runner, conf.WEBHOOK_HOST, conf.WEBHOOK_PORT, reuse_port=workers > 1).start()
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await shutdown(tasks)
+
+def run_webhook_worker(workers):
+    asyncio.run(webhook_worker(workers))
+
+# Migrate database and register webhook once, before workers start
+async def prepare_webhook():
+    if dp is None:
+        create_app()
+    db.start()
+    await migrations.migrate(db)
+    await db.close()
+
+    await bot.set_webhook(conf.WEBHOOK_URL + conf.WEBHOOK_PATH,
+                          secret_token=conf.WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    await bot.session.close()
+
+# Start worker processes
+# Shared state lives in SQLite, callback data and payment metadata, so any worker can serve any update
+def run_webhook(workers):
+    import multiprocessing
+
+    asyncio.run(prepare_webhook())
+
+    if workers == 1:
+        run_webhook_worker(workers)
+        return
+
+    # Spawn gives every worker its own connections instead of copies of parent ones
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_webhook_worker, args=(workers,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+# Warm up sessions cache with latest buyers, no more users than cache can hold
+# Subscriptions are loaded by batches of users, one query per batch instead of one per user
+async def load_user_data(limit=None, batch_size=None):
+    limit = conf.SESSION_CACHE_SIZE if limit is None else limit
+    batch_size = conf.SESSION_WARMUP_BATCH if batch_size is None else batch_size
+    rows = await db.fetchall("SELECT user_id FROM subscriptions GROUP BY user_id ORDER BY MAX(id) DESC LIMIT ?",
+                             (min(limit, conf.SESSION_CACHE_SIZE),))
+    user_ids = [row[0] for row in rows]
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        subscriped = {user_id: [] for user_id in batch}
+
+        rows = await db.fetchall(f"SELECT user_id, offer, key FROM subscriptions WHERE user_id IN ({','.join('?' * len(batch))}) "
+                                 "AND (expires_at IS NULL OR expires_at>?) ORDER BY id",
+                                 (*batch, now))
+        for user_id, offer, key in rows:
+            subscriped[user_id].append({"offer": offer, "key": key})
+
+        for user_id in batch:
+            user_data = user_data_list.get(user_id)
+            # User could buy something while warm-up was running, loaded list is already fresh
+            if user_data.subscriped is None:
+                user_data.subscriped = subscriped[user_id]
+
+    logging.info("Sessions warmed up: %s", len(user_ids))
 
 # Using asyncio run main func
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--workers', type=int, default=config.WEBHOOK_WORKERS)
+    args = parser.parse_args()
+
+    if args.mode == 'webhook':
+        run_webhook(args.workers)
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,121 @@
+# Prometheus-style metrics without extra dependencies, exposed as text on /metrics by monitoring.py
+# Only standard library here, payment and storage count their calls without importing aiogram or aiohttp
+# Budget: one observation is a dict lookup plus bisect, a few microseconds per update
+import asyncio
+import bisect
+import time
+
+# Default latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        # collect() returns {labels tuple: value}, called on every scrape
+        self.collect = collect
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return super().samples()
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {} # labels -> [bucket counts..., +Inf count, sum, count]
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * (len(self.buckets) + 3)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    # Measure block duration: with histogram.time('label'): ...
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), data):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels((*self.labels, "le"), (*labels, bound))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} {data[-2]}'
+            yield f'{self.name}_count{format_labels(self.labels, labels)} {data[-1]}'
+
+class Timer():
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+# Metrics of the bot
+handler_latency = Histogram('bot_handler_seconds', 'Update handling time', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Handlers that raised', ('handler',))
+loop_lag = Gauge('bot_event_loop_lag_seconds', 'Delay of scheduled wakeup of event loop')
+yookassa_latency = Histogram('bot_yookassa_seconds', 'YooKassa API call time', ('method',))
+yookassa_errors = Counter('bot_yookassa_errors_total', 'Failed YooKassa API calls', ('method',))
+sqlite_latency = Histogram('bot_sqlite_batch_seconds', 'SQLite write transaction time')
+sqlite_batch = Histogram('bot_sqlite_batch_size', 'Writes committed in one transaction', buckets=(1, 5, 10, 25, 50, 100, 200, 500))
+funnel = Counter('bot_funnel_total', 'Users passing purchase steps', ('step',))
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+# Measure how late event loop wakes up, blocking code shows up here
+async def watch_loop_lag(interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.set(max(loop.time() - start - interval, 0))
@@ -0,0 +1,124 @@
+# Versioned database schema, applied version is kept in PRAGMA user_version
+import logging
+
+# Tables of the first bot version, they may already exist without any version
+def initial_tables(conn):
+    # - potential_customers: for storing information about potential customers that has already started communication with bot
+    # - customers: for storing information about customers that has already bought the plan
+    conn.execute("CREATE TABLE IF NOT EXISTS potential_customers(username text, date text)")
+    conn.execute("CREATE TABLE IF NOT EXISTS customers(username text, date_purchase text, key text, term text)")
+    conn.execute("CREATE TABLE IF NOT EXISTS subscriptions(user_id integer, offer text, key text)")
+
+# Subscriptions get primary key, purchase/expiry dates and index by user
+def subscriptions_with_dates(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(subscriptions)")]
+    if 'id' not in columns:
+        conn.execute("ALTER TABLE subscriptions RENAME TO subscriptions_old")
+        conn.execute("""CREATE TABLE subscriptions(id integer PRIMARY KEY,
+                                                   user_id integer NOT NULL,
+                                                   offer text,
+                                                   key text,
+                                                   purchased_at text,
+                                                   expires_at text)""")
+        conn.execute("INSERT INTO subscriptions (user_id, offer, key) SELECT user_id, offer, key FROM subscriptions_old")
+        conn.execute("DROP TABLE subscriptions_old")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS subscriptions_user_id ON subscriptions(user_id)")
+
+# Potential customers are keyed by Telegram user id, username may be empty or changed
+def potential_customers_by_user_id(conn):
+    conn.execute("ALTER TABLE potential_customers RENAME TO potential_customers_old")
+    conn.execute("""CREATE TABLE potential_customers(id integer PRIMARY KEY,
+                                                     user_id integer,
+                                                     username text,
+                                                     date text)""")
+    # Old rows don't have user id, they are kept with NULL for history
+    conn.execute("INSERT INTO potential_customers (username, date) SELECT username, date FROM potential_customers_old")
+    conn.execute("DROP TABLE potential_customers_old")
+    conn.execute("CREATE UNIQUE INDEX potential_customers_user_id ON potential_customers(user_id)")
+
+# Every created payment is recorded, so it can be settled without user and after restart
+def orders(conn):
+    conn.execute("""CREATE TABLE orders(pay_id text PRIMARY KEY,
+                                       chat_id integer NOT NULL,
+                                       username text,
+                                       plan text,
+                                       title text,
+                                       days integer,
+                                       country text,
+                                       amount integer,
+                                       status text NOT NULL,
+                                       attempts integer NOT NULL DEFAULT 0,
+                                       created_at text,
+                                       next_check_at text)""")
+    # Reconciliation picks due pending orders by index
+    conn.execute("CREATE INDEX orders_status_next_check ON orders(status, next_check_at)")
+
+# Expiry reminders and abandoned cart nudges, partial indexes keep only rows still waiting
+def reminders(conn):
+    conn.execute("ALTER TABLE subscriptions ADD COLUMN reminded integer NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX subscriptions_remind ON subscriptions(expires_at) WHERE reminded=0")
+    conn.execute("ALTER TABLE orders ADD COLUMN nudged integer NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX orders_nudge ON orders(created_at) WHERE nudged=0")
+
+# VPN keys inventory, replaces keys/*.txt files
+# Table could be created by inventory itself before it moved here, so everything is created only if missing
+def key_inventory(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS keys(id integer PRIMARY KEY,
+                                                 country text NOT NULL,
+                                                 key text NOT NULL,
+                                                 state integer NOT NULL DEFAULT 0,
+                                                 chat_id integer,
+                                                 username text,
+                                                 issued_at text,
+                                                 pay_id text,
+                                                 UNIQUE(country, key))""")
+    # Inventories created before keys were bound to payments
+    if 'pay_id' not in [row[1] for row in conn.execute("PRAGMA table_info(keys)")]:
+        conn.execute("ALTER TABLE keys ADD COLUMN pay_id text")
+
+    # Next free key of the country is found by index without scanning the table
+    conn.execute("CREATE INDEX IF NOT EXISTS keys_country_state ON keys(country, state, id)")
+    # One payment never gets two keys, even if it's settled by several processes
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS keys_pay_id ON keys(pay_id)")
+
+# Key already known in any country is never imported again, so one key is never sold twice
+def keys_by_key(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS keys_key ON keys(key)")
+
+# Sold key is marked delivered after it's sent, keys sold before are treated as delivered
+def key_delivery(conn):
+    conn.execute("ALTER TABLE keys ADD COLUMN delivered integer NOT NULL DEFAULT 1")
+
+# Add new migrations only to the end
+MIGRATIONS = [initial_tables,
+              subscriptions_with_dates,
+              potential_customers_by_user_id,
+              orders,
+              reminders,
+              key_inventory,
+              keys_by_key,
+              key_delivery]
+
+def apply_migrations(conn) -> int:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Savepoint makes every migration atomic, DDL isn't wrapped in transaction automatically
+        conn.execute("SAVEPOINT migration")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            conn.execute("ROLLBACK TO migration")
+            raise
+        finally:
+            conn.execute("RELEASE migration")
+
+        logging.info("Applied migration %s: %s", number, migration.__name__)
+
+    return len(MIGRATIONS)
+
+# Bring database schema to the latest version
+async def migrate(db) -> int:
+    return await db.write(apply_migrations)
@@ -0,0 +1,38 @@
+# Bot side of metrics: handler middleware and /metrics route, counters themselves live in metrics.py
+import ipaddress
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+import metrics
+
+# Handler latency and errors for message and callback handlers
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+        finally:
+            metrics.handler_latency.observe(time.perf_counter() - start, name)
+
+# Metrics are only for local network, server itself may be public for webhooks
+def is_local(remote) -> bool:
+    try:
+        address = ipaddress.ip_address(remote)
+    except (TypeError, ValueError):
+        return False
+    return address.is_loopback or address.is_private
+
+def add_routes(app, path):
+    async def metrics_handler(request):
+        if not is_local(request.remote):
+            return web.Response(status=403)
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app.router.add_get(path, metrics_handler)
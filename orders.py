@@ -0,0 +1,106 @@
+# Pending orders and background reconciliation of their payments
+import asyncio
+import datetime
+import logging
+
+# Order statuses
+PENDING = 'pending'
+PAID = 'paid' # Paid, but there was no free key, key is issued after refill
+SETTLED = 'settled'
+CANCELED = 'canceled'
+EXPIRED = 'expired'
+
+def timestamp(moment) -> str:
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+class Orders():
+    def __init__(self, db, batch_size, base_delay, max_delay, ttl):
+        self.db = db
+        self.batch_size = batch_size
+        self.base_delay = base_delay # Seconds before first check, doubles after every check
+        self.max_delay = max_delay
+        self.ttl = ttl # Seconds after which unpaid order is expired
+
+    # Record new payment right after it was created
+    async def create(self, pay_id, chat_id, username, plan, country, amount):
+        now = datetime.datetime.now()
+        await self.db.execute('''INSERT OR IGNORE INTO orders (pay_id, chat_id, username, plan, title, days, country, amount,
+                                                               status, created_at, next_check_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                              (pay_id, chat_id, username, plan.id, plan.title, plan.days, country, amount,
+                               PENDING, timestamp(now), timestamp(now + datetime.timedelta(seconds=self.base_delay))))
+
+    async def set_status(self, pay_id, status):
+        await self.db.execute("UPDATE orders SET status=? WHERE pay_id=?", (status, pay_id))
+
+    # Paid order waiting for keys, it's not nudged as unpaid and reconciliation still settles it
+    async def mark_paid(self, pay_id):
+        await self.db.execute("UPDATE orders SET status=? WHERE pay_id=? AND status=?", (PAID, pay_id, PENDING))
+
+    # Metadata for settlement, same as stored in payment
+    @staticmethod
+    def metadata(row) -> dict:
+        pay_id, chat_id, username, title, days, country = row[:6]
+        return {'chat_id': chat_id, 'username': username, 'title': title, 'days': days, 'country': country}
+
+    # Atomically take due orders and move their next check forward, so every order is checked by one worker
+    # Paid orders without key are taken too, they are settled again when keys appear
+    # If worker dies before the check, order is taken again after max_delay
+    async def due(self, now):
+        lease = timestamp(now + datetime.timedelta(seconds=self.max_delay))
+        return await self.db.write(lambda conn: conn.execute('''UPDATE orders SET next_check_at=?, attempts=attempts+1
+                                                                WHERE pay_id IN (SELECT pay_id FROM orders
+                                                                                 WHERE status IN (?, ?) AND next_check_at<=?
+                                                                                 ORDER BY next_check_at LIMIT ?)
+                                                                RETURNING pay_id, chat_id, username, title, days, country,
+                                                                          attempts, created_at''',
+                                                             (lease, PENDING, PAID, timestamp(now), self.batch_size)).fetchall())
+
+    # Check one batch of due orders, returns how many were checked
+    async def reconcile_batch(self, check, submit) -> int:
+        now = datetime.datetime.now()
+        rows = await self.due(now)
+
+        results = await asyncio.gather(*[check(row[0]) for row in rows], return_exceptions=True)
+
+        for row, result in zip(rows, results):
+            pay_id, attempts, created_at = row[0], row[6], row[7]
+
+            if isinstance(result, Exception):
+                logging.warning("Order %s check failed: %s", pay_id, result)
+                status = None
+            else:
+                status = result[0]
+
+            if status == 'succeeded':
+                # Status becomes settled after key is issued
+                submit(pay_id, self.metadata(row))
+                delay = self.max_delay
+            elif status == 'canceled':
+                await self.set_status(pay_id, CANCELED)
+                continue
+            # Only order that YooKassa reported as not paid is expired, failed check may hide paid one
+            elif status is not None and created_at < timestamp(now - datetime.timedelta(seconds=self.ttl)):
+                await self.set_status(pay_id, EXPIRED)
+                continue
+            else:
+                # Exponential backoff keeps API calls bounded for orders that are never paid
+                # attempts already counts this check
+                delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+            await self.db.execute("UPDATE orders SET next_check_at=? WHERE pay_id=? AND status IN (?, ?)",
+                                  (timestamp(now + datetime.timedelta(seconds=delay)), pay_id, PENDING, PAID))
+
+        return len(rows)
+
+    # Background worker, check(pay_id) returns (status, metadata), submit(pay_id, metadata) settles order
+    async def reconcile(self, check, submit, interval):
+        while True:
+            try:
+                # Full batch means there may be more due orders, continue without pause
+                while await self.reconcile_batch(check, submit) == self.batch_size:
+                    pass
+            except Exception:
+                logging.exception("Orders reconciliation failed")
+
+            await asyncio.sleep(interval)
@@ -1,23 +1,170 @@
 # Using YooKassa API implement payments for TG bot
-import yookassa
-from yookassa import Payment
-import uuid
+# SDK is imported on first payment: it pulls requests and friends, and bot doesn't need it to start
+import asyncio
+import logging
+import random
 import time
+import uuid
+
+import metrics
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Defaults from config, replaced by configure()
+from config import ACCOUNT_ID, SECRET_KEY, YOOKASSA_API_URL, PAYMENT_RETURN_URL
+from config import PAYMENT_WORKERS, PAYMENT_POLL_INTERVAL, PAYMENT_POLL_ATTEMPTS
+from config import PAYMENT_TIMEOUT, PAYMENT_RETRIES, PAYMENT_RETRY_DELAY, BREAKER_FAILURES, BREAKER_RESET
+from config import PAYMENT_LINK_TTL, PAYMENT_LINKS_SIZE
+
+# YooKassa is unreachable, slow or circuit breaker is open, user should try later
+class PaymentUnavailable(Exception):
+    pass
+
+# Stops calling YooKassa after several failures in a row, so users get an answer at once instead of waiting for timeouts
+# After reset seconds one trial call is let through: success closes breaker, failure opens it again
+class CircuitBreaker():
+    def __init__(self, failures, reset):
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False # Trial call is running, others still fail fast
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset:
+            return 'open'
+        return 'half-open'
+
+    # Check if call may go to YooKassa
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        # Failed trial or too many failures in a row
+        if self.trial or self.failures >= self.max_failures:
+            if self.opened_at is None or self.trial:
+                logging.warning("YooKassa circuit breaker opened after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+metrics.Gauge('bot_yookassa_breaker_open', 'YooKassa circuit breaker is open (1) or closed (0)',
+              collect=lambda: {(): int(breaker.state != 'closed')})
+
+# Account and API address, applied to SDK when it's imported
+account = {'account_id': ACCOUNT_ID, 'secret_key': SECRET_KEY, 'api_url': YOOKASSA_API_URL}
+sdk = None
+
+# Take account, API address, timeouts and pool size from config (module or config.override() copy)
+# SDK keeps account process wide, YOOKASSA_API_URL lets load test talk to a fake YooKassa instead of the real one
+def configure(conf):
+    global sdk, executor, breaker
+    global PAYMENT_RETURN_URL, PAYMENT_POLL_INTERVAL, PAYMENT_POLL_ATTEMPTS, PAYMENT_TIMEOUT, PAYMENT_RETRIES, PAYMENT_RETRY_DELAY
+    account.update(account_id=conf.ACCOUNT_ID, secret_key=conf.SECRET_KEY, api_url=conf.YOOKASSA_API_URL)
+    # Applied again on next request
+    sdk = None
+
+    PAYMENT_RETURN_URL = conf.PAYMENT_RETURN_URL
+    PAYMENT_POLL_INTERVAL = conf.PAYMENT_POLL_INTERVAL
+    PAYMENT_POLL_ATTEMPTS = conf.PAYMENT_POLL_ATTEMPTS
+    PAYMENT_TIMEOUT = conf.PAYMENT_TIMEOUT
+    PAYMENT_RETRIES = conf.PAYMENT_RETRIES
+    PAYMENT_RETRY_DELAY = conf.PAYMENT_RETRY_DELAY
+    breaker = CircuitBreaker(conf.BREAKER_FAILURES, conf.BREAKER_RESET)
+
+    # Pool threads are started on first call, so replacing unused pool costs nothing
+    executor.shutdown(wait=False)
+    executor = ThreadPoolExecutor(max_workers=conf.PAYMENT_WORKERS, thread_name_prefix='yookassa')
+
+# Payment class of configured SDK
+def client():
+    global sdk
+    if sdk is None:
+        import yookassa
+
+        yookassa.Configuration.account_id = account['account_id']
+        yookassa.Configuration.secret_key = account['secret_key']
+        if account['api_url']:
+            yookassa.Configuration.api_url = account['api_url'].rstrip('/')
+        # Thread is not blocked longer than event loop waits for it
+        yookassa.Configuration.timeout = PAYMENT_TIMEOUT
 
-# Get config with all important data
-from config import ACCOUNT_ID, SECRET_KEY
+        sdk = yookassa.Payment
+    return sdk
 
-# Apply account_id and secret_key here
-yookassa.Configuration.account_id = ACCOUNT_ID
-yookassa.Configuration.secret_key = SECRET_KEY
+# YooKassa SDK is synchronous, so every request runs in this bounded pool instead of the event loop
+executor = ThreadPoolExecutor(max_workers=PAYMENT_WORKERS, thread_name_prefix='yookassa')
+
+# Run blocking SDK call in the payment pool, latency and errors go to metrics
+async def run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor, func, *args)
+    except Exception:
+        metrics.yookassa_errors.inc(func.__name__)
+        raise
+    finally:
+        metrics.yookassa_latency.observe(time.perf_counter() - start, func.__name__)
+
+# Client errors (bad request, auth, not found) will fail again, server errors and timeouts are worth retrying
+def permanent(error) -> bool:
+    code = getattr(error, 'HTTP_CODE', None)
+    return code is not None and 400 <= code < 500 and code != 429
+
+# Call SDK with timeout, bounded retries and circuit breaker
+# Retries wait random time up to exponentially growing delay (full jitter), so workers don't retry in lockstep
+async def call(func, *args):
+    for attempt in range(PAYMENT_RETRIES + 1):
+        if not breaker.allow():
+            raise PaymentUnavailable('circuit breaker is open')
+
+        try:
+            result = await asyncio.wait_for(run_in_pool(func, *args), PAYMENT_TIMEOUT)
+        except asyncio.CancelledError:
+            # Trial call was not finished, next call may try again
+            breaker.trial = False
+            raise
+        except Exception as e:
+            if permanent(e):
+                # YooKassa answered, it's alive
+                breaker.success()
+                raise
+
+            breaker.failure()
+            if attempt == PAYMENT_RETRIES:
+                raise PaymentUnavailable(f'{func.__name__} failed: {e!r}') from e
+
+            await asyncio.sleep(random.uniform(0, PAYMENT_RETRY_DELAY * 2 ** attempt))
+            continue
+
+        breaker.success()
+        return result
 
 # Implement function that will create offer to the user and return tuple with data
-def create(amount, chat_id, description) -> tuple:
-    # Generate id_key for offer
+# Extra metadata (country, plan title...) is returned back by YooKassa with payment notifications
+async def create(amount, chat_id, description, metadata=None) -> tuple:
+    # Generate id_key for offer, retries send the same key, so YooKassa never creates second payment
     id_key = str(uuid.uuid4())
 
     # Create Payment object
-    payment = Payment.create({
+    payment = await call(client().create, {
     "amount": {
       "value": amount,
       "currency": "RUB"
@@ -27,25 +174,78 @@ def create(amount, chat_id, description) -> tuple:
     },
     "confirmation": {
       "type": "redirect",
-      "return_url": "https://t.me/vpngivverbot"
+      "return_url": PAYMENT_RETURN_URL
     },
     "capture": True,
     "metadata": {
-        'chat_id': chat_id
+        'chat_id': chat_id,
+        **(metadata or {})
     },
     'description': description}, id_key)
 
     # Return all data from payment object
     return payment.confirmation.confirmation_url, payment.id
 
+# Get current payment status without waiting, returns tuple (status, metadata)
+async def status(payment_id) -> tuple:
+    payment = await call(client().find_one, payment_id)
+    return payment.status, payment.metadata
+
 # Implement function that will check all data from the generated payment by id
-def check(payment_id) -> bool:
-    while True:
-      time.sleep(3)
+# Payment is polled a few times with non-blocking pauses, so other updates are served meanwhile
+# Defaults are read on call, configure() may change them
+async def check(payment_id, interval=None, attempts=None):
+    for _ in range(PAYMENT_POLL_ATTEMPTS if attempts is None else attempts):
+      await asyncio.sleep(PAYMENT_POLL_INTERVAL if interval is None else interval)
 
-      payment = yookassa.Payment.find_one(payment_id)
+      payment = await call(client().find_one, payment_id)
 
       if payment.status == 'succeeded':
           return payment.metadata
-      else:
-          return False
+
+      # Cancelled payment will never succeed, stop polling
+      if payment.status == 'canceled':
+          break
+
+    return False
+
+# Created but not paid payments per (chat, plan...), repeated taps get the same link instead of new payment
+class PaymentLinks():
+    def __init__(self, ttl=PAYMENT_LINK_TTL, max_size=PAYMENT_LINKS_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.links = OrderedDict() # key -> (pay_url, pay_id, expires_at)
+        self.keys = {} # pay_id -> key
+
+    # Returns (pay_url, pay_id) or None
+    def get(self, key):
+        link = self.links.get(key)
+        if link is None:
+            return None
+
+        if link[2] < time.monotonic():
+            self.drop(link[1])
+            return None
+
+        return link[0], link[1]
+
+    def put(self, key, pay_url, pay_id):
+        self.drop_key(key)
+        self.links[key] = (pay_url, pay_id, time.monotonic() + self.ttl)
+        self.keys[pay_id] = key
+
+        # Oldest links go first, they expire first too
+        while len(self.links) > self.max_size:
+            _, (_, old_id, _) = self.links.popitem(last=False)
+            self.keys.pop(old_id, None)
+
+    def drop_key(self, key):
+        link = self.links.pop(key, None)
+        if link is not None:
+            self.keys.pop(link[1], None)
+
+    # Paid or canceled payment must not be offered again
+    def drop(self, pay_id):
+        key = self.keys.pop(pay_id, None)
+        if key is not None:
+            self.links.pop(key, None)
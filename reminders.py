@@ -0,0 +1,74 @@
+# Scheduled sweeps: renewal reminders before subscription expiry and nudges for unpaid orders
+import asyncio
+import datetime
+import logging
+
+import orders # Order statuses
+
+def timestamp(moment) -> str:
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+class Reminders():
+    def __init__(self, db, batch_size, remind_before, nudge_after):
+        self.db = db
+        self.batch_size = batch_size
+        self.remind_before = remind_before # Max seconds before expiry to send renewal reminder
+        self.nudge_after = nudge_after # Seconds after unpaid order was created to ask about problems
+
+    # Atomically take due subscriptions, so every reminder is sent once even with several workers
+    # Short plans are reminded in the last quarter of their term, one day plan isn't reminded right after purchase
+    async def due_subscriptions(self):
+        now = datetime.datetime.now()
+        deadline = timestamp(now + datetime.timedelta(seconds=self.remind_before))
+        return await self.db.write(lambda conn: conn.execute('''UPDATE subscriptions SET reminded=1
+                                                                WHERE id IN (SELECT id FROM subscriptions
+                                                                             WHERE reminded=0 AND expires_at<=?
+                                                                             AND (purchased_at IS NULL
+                                                                                  OR (julianday(expires_at) - julianday(?)) * 4
+                                                                                     <= julianday(expires_at) - julianday(purchased_at))
+                                                                             ORDER BY expires_at LIMIT ?)
+                                                                RETURNING user_id, offer, expires_at''',
+                                                             (deadline, timestamp(now), self.batch_size)).fetchall())
+
+    # Same for unpaid orders, one nudge per chat is enough
+    async def due_orders(self):
+        deadline = timestamp(datetime.datetime.now() - datetime.timedelta(seconds=self.nudge_after))
+        return await self.db.write(lambda conn: conn.execute('''UPDATE orders SET nudged=1
+                                                                WHERE pay_id IN (SELECT pay_id FROM orders
+                                                                                 WHERE nudged=0 AND created_at<=?
+                                                                                 ORDER BY created_at LIMIT ?)
+                                                                RETURNING chat_id, status''',
+                                                             (deadline, self.batch_size)).fetchall())
+
+    # One sweep, returns how many reminders were sent
+    async def sweep(self, remind, nudge) -> int:
+        sent = 0
+
+        rows = await self.due_subscriptions()
+        while rows:
+            await asyncio.gather(*[remind(user_id, offer, expires_at) for user_id, offer, expires_at in rows],
+                                 return_exceptions=True)
+            sent += len(rows)
+            rows = await self.due_subscriptions() if len(rows) == self.batch_size else []
+
+        rows = await self.due_orders()
+        while rows:
+            # Paid orders are only marked, their chats don't need a nudge, even if they still wait for a key
+            chats = {chat_id for chat_id, status in rows if status in (orders.PENDING, orders.EXPIRED)}
+            await asyncio.gather(*[nudge(chat_id) for chat_id in chats], return_exceptions=True)
+            sent += len(chats)
+            rows = await self.due_orders() if len(rows) == self.batch_size else []
+
+        return sent
+
+    # Background worker, remind(user_id, offer, expires_at) and nudge(chat_id) send messages
+    async def run(self, remind, nudge, interval):
+        while True:
+            try:
+                sent = await self.sweep(remind, nudge)
+                if sent:
+                    logging.info("Reminders sent: %s", sent)
+            except Exception:
+                logging.exception("Reminders sweep failed")
+
+            await asyncio.sleep(interval)
@@ -0,0 +1,160 @@
+# Outbound Telegram messages go through prioritized queue with global and per-chat rate limits
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage, DeleteMessage
+
+# Priority classes, lower goes first
+DELIVERY = 0 # Keys and payment results
+NORMAL = 1 # Replies to user actions
+BULK = 2 # Reminders and other mailings
+
+class TokenBucket():
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Take one token, returns how many seconds caller has to wait for it
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # Seconds until one token is available, nothing is taken
+    def delay(self) -> float:
+        tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    # Take one token only if it's there, never goes into debt
+    def try_take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    # Bucket is full again, chat can be forgotten
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+# Limits of one chat
+class ChatState():
+    __slots__ = ('bucket', 'lock', 'parked_until')
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.lock = asyncio.Lock() # Keeps messages of one chat in order while they are sent
+        self.parked_until = 0 # Messages of the chat wait in timers until then, newer ones wait behind them
+
+class Sender():
+    def __init__(self, bot, global_rate, chat_rate, chat_burst, workers, max_retries):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        # No burst: full bucket would let twice the rate through in the first second and Telegram answers 429
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats = {} # chat_id -> ChatState
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count() # Keeps FIFO order inside one priority
+        self.paused_until = 0
+        self.tasks = []
+
+    # Change bot-wide limit, e.g. when it's shared between several processes
+    def set_global_rate(self, rate):
+        self.global_bucket = TokenBucket(rate, 1)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # Queue Telegram method and wait for its result
+    async def call(self, method, priority=NORMAL):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.counter), method, future, 0))
+        return await future
+
+    async def send_message(self, chat_id, text, priority=NORMAL, **kwargs):
+        return await self.call(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    async def delete_message(self, chat_id, message_id, priority=NORMAL):
+        return await self.call(DeleteMessage(chat_id=chat_id, message_id=message_id), priority)
+
+    def chat(self, chat_id):
+        state = self.chats.get(chat_id)
+        if state is None:
+            # Forget chats that don't send anything, so state stays small
+            if len(self.chats) > 10000:
+                now = time.monotonic()
+                for idle_id in [key for key, chat in self.chats.items()
+                                if chat.bucket.idle() and not chat.lock.locked() and chat.parked_until <= now]:
+                    del self.chats[idle_id]
+
+            state = self.chats[chat_id] = ChatState(self.chat_rate, self.chat_burst)
+        return state
+
+    # Put message back to the queue after delay, worker is free to send other chats meanwhile
+    def park(self, item, delay):
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, item)
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, number, method, future, attempt = item
+            try:
+                if future.cancelled():
+                    continue
+
+                now = time.monotonic()
+                chat = self.chat(method.chat_id)
+
+                # Flood pause, chat limit, or older messages of this chat are still parked: wait in timer, not in worker
+                wait = max(self.paused_until - now, chat.parked_until - now, chat.bucket.delay())
+                if wait > 0:
+                    chat.parked_until = max(chat.parked_until, now + wait)
+                    self.park(item, wait)
+                    continue
+
+                chat.bucket.take()
+                # Global limit is shared by all chats, every worker would wait for it anyway
+                await asyncio.sleep(self.global_bucket.take())
+
+                # Lock keeps messages of one chat in order
+                async with chat.lock:
+                    try:
+                        result = await self.bot(method)
+                    except TelegramRetryAfter as e:
+                        # Flood limit: stop all sends for a while and retry the same message
+                        self.paused_until = time.monotonic() + e.retry_after
+                        if attempt < self.max_retries:
+                            self.queue.put_nowait((priority, number, method, future, attempt + 1))
+                        elif not future.done():
+                            future.set_exception(e)
+                        continue
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+
+                if not future.done():
+                    future.set_result(result)
+            except Exception:
+                logging.exception("Outbound message failed")
+            finally:
+                self.queue.task_done()
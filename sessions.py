@@ -0,0 +1,58 @@
+# Bounded cache of personal user data with LRU and TTL eviction
+import time
+
+from collections import OrderedDict
+
+class SessionCache():
+    def __init__(self, factory, max_size, ttl, purchase_ttl):
+        # factory(user_id) creates new session object on cache miss
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.purchase_ttl = purchase_ttl
+        self.items = OrderedDict() # user_id -> (session, last access time)
+
+    # Get session, creating it if needed, and mark it as recently used
+    def get(self, user_id):
+        now = time.monotonic()
+        entry = self.items.pop(user_id, None)
+        session = entry[0] if entry else self.factory(user_id)
+        self.items[user_id] = (session, now)
+
+        if entry is None:
+            self.evict(now)
+
+        return session
+
+    # Get session only if it's cached, doesn't change LRU order
+    def peek(self, user_id):
+        entry = self.items.get(user_id)
+        return entry[0] if entry else None
+
+    def __contains__(self, user_id):
+        return user_id in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    # Session in the middle of purchase lives longer, so selected country and plan aren't lost
+    def expired(self, session, last_access, now) -> bool:
+        ttl = self.purchase_ttl if session.country or session.title else self.ttl
+        return now - last_access > ttl
+
+    # Drop least recently used sessions above the size cap and expired ones, oldest first
+    # Cap is hard: session in the middle of purchase is evicted too if it's the oldest one
+    # Every step removes entry from the front, so eviction is O(1) per new session on average
+    def evict(self, now):
+        # Newest session is never evicted, it was just requested
+        while len(self.items) > max(self.max_size, 1):
+            self.items.popitem(last=False)
+
+        while len(self.items) > 1:
+            user_id, (session, last_access) = next(iter(self.items.items()))
+
+            # Oldest entry is still alive, entries behind it were used later
+            if not self.expired(session, last_access, now):
+                break
+
+            del self.items[user_id]
@@ -0,0 +1,162 @@
+# Prices, plans, countries and message texts that can be changed without restart
+# Defaults come from config.py and catalog.py, SETTINGS_FILE (JSON) overrides them:
+# {"messages": {"BUY": "..."}, "prices": {"one_day": 10}, "plans": [...], "countries": [{"id": "germany", "title": "..."}]}
+import asyncio
+import json
+import logging
+import os
+import re
+
+from types import MappingProxyType
+
+import config
+import catalog
+
+# Texts that can be changed
+MESSAGES = ['TUTORIAL', 'BUY', 'SUBSCRIPTIONS', 'REVIEWS', 'SUPPORT', 'ANY_COUNTRY', 'COUNTRIES', 'WHICH_COUNTRY',
+            'SUB_ERR', 'SUPPORT_INFO', 'BACK_TO_MENU', 'PAYMENT_ERROR', 'PAYMENT_NO_STOCK', 'PAYMENT_UNAVAILABLE',
+            'REMINDER', 'PROPOSE_PLAN', 'RENEWAL']
+
+# Ids are used in callback data and key file names
+ID_PATTERN = re.compile(r'^[a-z0-9_]{1,24}$')
+
+# Immutable settings, handlers read settings.current and it is only replaced as a whole
+class Snapshot():
+    def __init__(self, messages, plans, countries):
+        for name, text in messages.items():
+            object.__setattr__(self, name, text)
+        object.__setattr__(self, 'plans', MappingProxyType({plan.id: plan for plan in plans}))
+        object.__setattr__(self, 'countries', MappingProxyType({country.id: country for country in countries}))
+        # All key pools, "any country" keys are stored separately
+        object.__setattr__(self, 'key_countries', (*self.countries, catalog.ANY_COUNTRY))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings snapshot is read only")
+
+# Raise ValueError if data can't be used, nothing is swapped in this case
+def validate(data):
+    for kind in ('plans', 'countries'):
+        if not isinstance(data[kind], list) or not all(isinstance(item, dict) for item in data[kind]):
+            raise ValueError(f"{kind} must be list of objects")
+
+    messages = data['messages']
+    for name, text in messages.items():
+        if name not in MESSAGES:
+            raise ValueError(f"Unknown message {name}")
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"Message {name} must be non-empty text")
+
+    # Reply buttons are matched by text, so they must differ
+    buttons = [messages[name] for name in ('BUY', 'SUBSCRIPTIONS', 'REVIEWS', 'SUPPORT', 'ANY_COUNTRY', 'COUNTRIES')]
+    if len(set(buttons)) != len(buttons):
+        raise ValueError("Button texts must be unique")
+
+    for kind, items in (('plan', data['plans']), ('country', data['countries'])):
+        ids = [item['id'] for item in items]
+        if not ids:
+            raise ValueError(f"At least one {kind} is required")
+        if len(set(ids)) != len(ids):
+            raise ValueError(f"Duplicate {kind} id")
+        for id in ids:
+            if not isinstance(id, str) or not ID_PATTERN.match(id) or id == catalog.ANY_COUNTRY:
+                raise ValueError(f"Bad {kind} id {id!r}")
+
+    for plan in data['plans']:
+        for field in ('days', 'price'):
+            if not isinstance(plan[field], int) or plan[field] <= 0:
+                raise ValueError(f"Plan {plan['id']} {field} must be positive integer")
+        for field in ('title', 'label'):
+            if not isinstance(plan[field], str) or not plan[field].strip():
+                raise ValueError(f"Plan {plan['id']} {field} must be non-empty text")
+        discount = plan.get('discount')
+        if discount is not None and (not isinstance(discount, int) or not 0 < discount < 100):
+            raise ValueError(f"Plan {plan['id']} discount must be percent from 1 to 99")
+
+    for country in data['countries']:
+        if not isinstance(country['title'], str) or not country['title'].strip():
+            raise ValueError(f"Country {country['id']} title must be non-empty text")
+
+# File must be object with optional messages and prices objects, plans and countries lists
+def check_file(custom):
+    if not isinstance(custom, dict):
+        raise ValueError("Settings file must contain JSON object")
+    for name in ('messages', 'prices'):
+        if not isinstance(custom.get(name, {}), dict):
+            raise ValueError(f"{name} must be object")
+
+# Defaults from config and catalog
+def defaults() -> dict:
+    return {'messages': {name: getattr(config, name) for name in MESSAGES},
+            'plans': [{'id': plan.id, 'days': plan.days, 'price': plan.price, 'title': plan.title,
+                       'label': plan.label, 'discount': plan.discount} for plan in catalog.DEFAULT_PLANS],
+            'countries': [{'id': country.id, 'title': country.title} for country in catalog.DEFAULT_COUNTRIES]}
+
+# Read settings file over defaults, validate and build snapshot
+def load(path) -> Snapshot:
+    data = defaults()
+    prices = {}
+
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            custom = json.load(file)
+        check_file(custom)
+
+        data['messages'].update(custom.get('messages', {}))
+        if 'plans' in custom:
+            data['plans'] = custom['plans']
+        if 'countries' in custom:
+            data['countries'] = custom['countries']
+
+        # Short form for price changes only
+        prices = custom.get('prices', {})
+
+    try:
+        for plan in data['plans']:
+            plan['price'] = prices.get(plan['id'], plan['price'])
+
+        validate(data)
+        plans = [catalog.Plan(plan['id'], plan['days'], plan['price'], plan['title'], plan['label'], plan.get('discount'))
+                 for plan in data['plans']]
+        countries = [catalog.Country(country['id'], country['title']) for country in data['countries']]
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Bad settings: {e!r}")
+
+    return Snapshot(data['messages'], plans, countries)
+
+current = load(config.SETTINGS_FILE)
+
+# Load settings again, old snapshot stays if new one is invalid
+# prepare(snapshot) builds everything that depends on settings (keyboards) and returns function that swaps it in
+# It runs before the swap, so if it fails old settings and old keyboards stay together
+def reload(path, prepare=None) -> bool:
+    global current
+    try:
+        snapshot = load(path)
+        apply = prepare(snapshot) if prepare else None
+    except Exception as e:
+        logging.error("Settings were not reloaded: %r", e)
+        return False
+
+    # No await between, handlers never see new settings with old keyboards
+    current = snapshot
+    if apply:
+        apply()
+    return True
+
+# Watch settings file and reload it after every change
+async def watch(path, interval, prepare):
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    while True:
+        await asyncio.sleep(interval)
+
+        # Watcher must survive anything, otherwise hot reload silently stops
+        try:
+            new_mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+
+            if reload(path, prepare):
+                logging.info("Settings reloaded from %s", path)
+        except Exception:
+            logging.exception("Settings watch failed")
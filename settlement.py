@@ -0,0 +1,145 @@
+# Settlement pipeline: YooKassa notifications and user confirmations are settled here exactly once
+import asyncio
+import ipaddress
+import logging
+
+from aiohttp import web
+from collections import OrderedDict
+
+# Get config with all important data
+from config import SETTLEMENT_WORKERS, SETTLED_CACHE_SIZE, YOOKASSA_IPS
+
+# Networks YooKassa sends notifications from
+trusted_networks = [ipaddress.ip_network(net) for net in YOOKASSA_IPS]
+
+class Settlement():
+    def __init__(self, handler, lookup, workers=SETTLEMENT_WORKERS, cache_size=SETTLED_CACHE_SIZE):
+        # handler(pay_id, metadata) issues the key for paid order and returns (key, issued_now)
+        # key is None if it has to be retried later
+        self.handler = handler
+        # async lookup(pay_id) returns key already issued for payment (persisted settled record) or None
+        self.lookup = lookup
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.settled = OrderedDict() # pay_id -> key, recently settled payments
+        self.cache_size = cache_size
+        self.inflight = {} # pay_id -> task that settles it right now
+        self.tasks = []
+
+    # Key of settled payment from memory, no database or API calls
+    def issued(self, pay_id):
+        key = self.settled.get(pay_id)
+        if key is not None:
+            self.settled.move_to_end(pay_id)
+        return key
+
+    def remember(self, pay_id, key):
+        self.settled[pay_id] = key
+        self.settled.move_to_end(pay_id)
+        if len(self.settled) > self.cache_size:
+            self.settled.popitem(last=False)
+
+    # Run factory() once per payment, concurrent callers wait for the same result
+    # Returns (result, owner), owner is True only for the caller that started the work
+    async def once(self, pay_id, factory) -> tuple:
+        task = self.inflight.get(pay_id)
+        if task is not None:
+            return await asyncio.shield(task), False
+
+        task = asyncio.ensure_future(factory())
+        self.inflight[pay_id] = task
+        task.add_done_callback(lambda _: self.inflight.pop(pay_id, None))
+        return await asyncio.shield(task), True
+
+    # Returns (key, issued_now, paid), same as check_and_run(), because taps may wait for notification's task
+    async def run(self, pay_id, metadata) -> tuple:
+        key, issued_now = await self.handler(pay_id, metadata)
+        if key is not None:
+            self.remember(pay_id, key)
+        return key, issued_now, True
+
+    # Settle paid payment, returns (key, issued_now)
+    async def settle(self, pay_id, metadata) -> tuple:
+        key = self.issued(pay_id)
+        if key is not None:
+            return key, False
+
+        (key, issued_now, _), owner = await self.once(pay_id, lambda: self.run(pay_id, metadata))
+        return key, issued_now and owner
+
+    # Returns (key, issued_now, paid), paid payment may still have no key if there was no stock
+    async def check_and_run(self, pay_id, check) -> tuple:
+        # Payment could be settled before restart or by another process
+        key = await self.lookup(pay_id)
+        if key is not None:
+            self.remember(pay_id, key)
+            return key, False, True
+
+        metadata = await check(pay_id)
+        if not metadata:
+            return None, False, False
+
+        return await self.run(pay_id, metadata)
+
+    # Confirmation tap: check(pay_id) returns payment metadata if it's paid
+    # Returns (key, issued_now, paid, owner), taps coalesced with a running one get owner=False
+    # paid=True with key=None: payment received, key is issued later when keys are refilled
+    async def confirm(self, pay_id, check) -> tuple:
+        key = self.issued(pay_id)
+        if key is not None:
+            return key, False, True, True
+
+        (key, issued_now, paid), owner = await self.once(pay_id, lambda: self.check_and_run(pay_id, check))
+        return key, issued_now and owner, paid, owner
+
+    # Put payment into the queue, workers will settle it in background
+    def submit(self, pay_id, metadata):
+        self.queue.put_nowait((pay_id, metadata))
+
+    async def worker(self):
+        while True:
+            pay_id, metadata = await self.queue.get()
+            try:
+                await self.settle(pay_id, metadata)
+            except Exception:
+                logging.exception("Settlement of payment %s failed", pay_id)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+# Check that notification came from YooKassa
+def is_trusted(remote) -> bool:
+    try:
+        address = ipaddress.ip_address(remote)
+    except (TypeError, ValueError):
+        return False
+
+    return any(address in net for net in trusted_networks)
+
+# Register YooKassa notifications route in aiohttp application
+def add_routes(app, settlement, path):
+    async def notification_handler(request):
+        if not is_trusted(request.remote):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        # Only succeeded payments are interesting, all other events are just acknowledged
+        if data.get('event') == 'payment.succeeded':
+            obj = data.get('object') or {}
+            if obj.get('id') and obj.get('metadata'):
+                settlement.submit(obj['id'], obj['metadata'])
+
+        return web.Response(status=200)
+
+    app.router.add_post(path, notification_handler)
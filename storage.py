@@ -0,0 +1,134 @@
+# Async access to SQLite: reads and writes run in their own threads, writes are committed in batches
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+class Storage():
+    def __init__(self, path, batch_size, flush_interval):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # Max seconds write waits for other writes to share commit
+        self.writes = queue.Queue()
+        self.writer = None
+        self.reader = None
+        self.local = threading.local()
+
+    # Every thread uses its own connection
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            # WAL lets readers work while writer commits
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    # Threads are started by first read or write if start() was not called
+    def start(self):
+        if self.writer is not None:
+            return
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-reader')
+        self.writer = threading.Thread(target=self.write_loop, name='sqlite-writer', daemon=True)
+        self.writer.start()
+
+    # Wait for all queued writes and stop threads
+    async def close(self):
+        if self.writer is not None:
+            self.writes.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self.writer.join)
+            self.writer = None
+        if self.reader is not None:
+            self.reader.shutdown()
+            self.reader = None
+
+    # Writer thread: take first write, then collect more until batch is full or flush interval passed
+    def write_loop(self):
+        db = self.connection()
+        running = True
+        while running:
+            item = self.writes.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.writes.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self.commit_batch(db, batch)
+
+    # Run whole batch in one transaction, failed statement only fails its own caller
+    def commit_batch(self, db, batch):
+        start = time.perf_counter()
+        results = []
+        for func, future, loop in batch:
+            try:
+                results.append((future, loop, func(db), None))
+            except Exception as e:
+                results.append((future, loop, None, e))
+
+        try:
+            db.commit()
+        except Exception as e:
+            logging.exception("SQLite commit failed")
+            db.rollback()
+            results = [(future, loop, None, e) for future, loop, _, _ in results]
+
+        metrics.sqlite_latency.observe(time.perf_counter() - start)
+        metrics.sqlite_batch.observe(len(batch))
+
+        for future, loop, result, error in results:
+            loop.call_soon_threadsafe(self.resolve, future, result, error)
+
+    @staticmethod
+    def resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    # Queue function(db) for writer thread, result is available after commit
+    async def write(self, func):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.start()
+        self.writes.put((func, future, loop))
+        return await future
+
+    # Run function(db) in reader thread
+    async def read(self, func):
+        loop = asyncio.get_running_loop()
+        self.start()
+        return await loop.run_in_executor(self.reader, lambda: func(self.connection()))
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda db: db.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq):
+        return await self.write(lambda db: db.executemany(sql, seq).rowcount)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda db: db.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda db: db.execute(sql, params).fetchall())
@@ -0,0 +1,50 @@
+# Key claims: one key per payment, purchase rows written with the claim, undelivered key is sent again
+import sqlite3
+
+import pytest
+
+import inventory
+
+@pytest.fixture
+def keys(tmp_path):
+    keys = inventory.KeyInventory(str(tmp_path / 'bot.db'))
+    keys.add('germany', ['key-1', 'key-2'])
+    yield keys
+    keys.close()
+
+def record(cur, key):
+    cur.execute("INSERT INTO customers VALUES(?, ?, ?, ?)", ('user', 'now', key, 'Month'))
+
+def customers(keys):
+    return sqlite3.connect(keys.path).execute("SELECT key FROM customers").fetchall()
+
+def test_claim_records_purchase(keys):
+    assert keys.claim('germany', 1, 'user', 'pay-1', record) == ('key-1', True, False)
+    assert customers(keys) == [('key-1',)]
+    assert keys.available('germany') == 1
+
+def test_failed_record_keeps_key_free(keys):
+    def broken(cur, key):
+        raise sqlite3.OperationalError('disk is full')
+
+    with pytest.raises(sqlite3.OperationalError):
+        keys.claim('germany', 1, 'user', 'pay-1', broken)
+    assert keys.claim('germany', 1, 'user', 'pay-1', record) == ('key-1', True, False)
+
+def test_undelivered_key_is_claimed_again(keys):
+    keys.claim('germany', 1, 'user', 'pay-1', record)
+
+    # Message wasn't sent: same key comes back undelivered, purchase isn't recorded twice
+    assert keys.issued('pay-1') is None
+    assert keys.claim('germany', 1, 'user', 'pay-1', record) == ('key-1', False, False)
+    assert customers(keys) == [('key-1',)]
+
+    keys.mark_delivered('pay-1')
+    assert keys.issued('pay-1') == 'key-1'
+    assert keys.claim('germany', 1, 'user', 'pay-1', record) == ('key-1', False, True)
+
+def test_no_keys(keys):
+    keys.claim('germany', 1)
+    keys.claim('germany', 2)
+    assert keys.claim('germany', 3, 'user', 'pay-3', record) == (None, False, False)
+    assert customers(keys) == []
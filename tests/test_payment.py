@@ -0,0 +1,128 @@
+# YooKassa calls: retries, idempotence key and circuit breaker against SDK stub with injected faults
+import asyncio
+import time
+
+import pytest
+
+from types import SimpleNamespace
+
+import payment
+
+class ServerError(Exception):
+    HTTP_CODE = 500
+
+class BadRequest(Exception):
+    HTTP_CODE = 400
+
+# Stands in for yookassa.Payment, every call takes next fault from the list
+# Fault is exception to raise, seconds to hang or None for success
+class FakeSDK():
+    def __init__(self, faults=()):
+        self.faults = list(faults)
+        self.calls = []
+
+    def fault(self):
+        fault = self.faults.pop(0) if self.faults else None
+        if isinstance(fault, Exception):
+            raise fault
+        if fault:
+            time.sleep(fault)
+
+    def create(self, params, id_key):
+        self.calls.append(id_key)
+        self.fault()
+        return SimpleNamespace(id=f'pay-{len(self.calls)}',
+                               confirmation=SimpleNamespace(confirmation_url='https://pay.example/1'))
+
+    def find_one(self, payment_id):
+        self.calls.append(payment_id)
+        self.fault()
+        return SimpleNamespace(status='succeeded', metadata={'chat_id': '1'})
+
+@pytest.fixture
+def sdk(monkeypatch):
+    stub = FakeSDK()
+    monkeypatch.setattr(payment, 'sdk', stub)
+    monkeypatch.setattr(payment, 'breaker', payment.CircuitBreaker(3, 0.05))
+    monkeypatch.setattr(payment, 'PAYMENT_RETRIES', 2)
+    monkeypatch.setattr(payment, 'PAYMENT_RETRY_DELAY', 0)
+    monkeypatch.setattr(payment, 'PAYMENT_TIMEOUT', 0.05)
+    return stub
+
+def create():
+    return asyncio.run(payment.create(100, 1, 'Plan'))
+
+def test_retries_reuse_id_key(sdk):
+    sdk.faults = [ServerError(), ServerError()]
+
+    assert create() == ('https://pay.example/1', 'pay-3')
+    assert len(sdk.calls) == 3
+    # YooKassa gets the same idempotence key, so retries never create second payment
+    assert len(set(sdk.calls)) == 1
+    assert payment.breaker.state == 'closed'
+
+def test_new_payment_gets_new_id_key(sdk):
+    create()
+    create()
+
+    assert len(set(sdk.calls)) == 2
+
+def test_retries_are_bounded(sdk):
+    sdk.faults = [ServerError()] * 5
+
+    with pytest.raises(payment.PaymentUnavailable):
+        create()
+    assert len(sdk.calls) == 3
+
+def test_timeout_is_retried(sdk):
+    sdk.faults = [0.2]
+
+    create()
+    assert len(sdk.calls) == 2
+    assert len(set(sdk.calls)) == 1
+
+def test_client_error_is_not_retried(sdk):
+    sdk.faults = [BadRequest()]
+
+    with pytest.raises(BadRequest):
+        create()
+    assert len(sdk.calls) == 1
+    assert payment.breaker.state == 'closed'
+
+def test_breaker_opens_and_closes(sdk, monkeypatch):
+    monkeypatch.setattr(payment, 'PAYMENT_RETRIES', 0)
+    breaker = payment.breaker
+
+    async def status():
+        try:
+            return await payment.status('pay')
+        except payment.PaymentUnavailable as e:
+            return e
+
+    async def scenario():
+        sdk.faults = [ServerError()] * 3
+        for _ in range(3):
+            await status()
+        assert breaker.state == 'open'
+
+        # Open breaker fails fast without calling YooKassa
+        assert isinstance(await status(), payment.PaymentUnavailable)
+        assert len(sdk.calls) == 3
+
+        # Only one trial call goes through when breaker is half-open, failed trial opens it again
+        await asyncio.sleep(0.06)
+        assert breaker.state == 'half-open'
+        sdk.faults = [ServerError()]
+        results = await asyncio.gather(status(), status())
+        assert all(isinstance(result, payment.PaymentUnavailable) for result in results)
+        assert len(sdk.calls) == 4
+        assert breaker.state == 'open'
+
+        # Successful trial closes breaker
+        await asyncio.sleep(0.06)
+        assert await status() == ('succeeded', {'chat_id': '1'})
+        assert breaker.state == 'closed'
+        assert await status() == ('succeeded', {'chat_id': '1'})
+        assert len(sdk.calls) == 6
+
+    asyncio.run(scenario())
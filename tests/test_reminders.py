@@ -0,0 +1,30 @@
+# Nudges go only to chats that didn't pay
+import asyncio
+
+import migrations
+import orders
+import reminders
+import storage
+
+def test_paid_order_waiting_for_key_is_not_nudged(tmp_path):
+    async def scenario():
+        db = storage.Storage(str(tmp_path / 'bot.db'), 10, 0)
+        await migrations.migrate(db)
+        for pay_id, chat_id, status in (('unpaid', 1, orders.PENDING), ('no-stock', 2, orders.PAID),
+                                        ('expired', 3, orders.EXPIRED), ('settled', 4, orders.SETTLED)):
+            await db.execute("INSERT INTO orders (pay_id, chat_id, status, created_at) VALUES (?, ?, ?, '2020-01-01 00:00:00')",
+                             (pay_id, chat_id, status))
+
+        nudged = []
+
+        async def remind(user_id, offer, expires_at):
+            pass
+
+        async def nudge(chat_id):
+            nudged.append(chat_id)
+
+        await reminders.Reminders(db, 100, 0, 60).sweep(remind, nudge)
+        await db.close()
+        return sorted(nudged)
+
+    assert asyncio.run(scenario()) == [1, 3]
@@ -0,0 +1,90 @@
+# Payment is settled exactly once, however many taps and notifications arrive at the same time
+import asyncio
+
+import settlement
+
+TAPS = 100
+
+# Fake YooKassa check and key handler that count calls and take some time, so taps overlap
+class FakePayment():
+    def __init__(self, paid=True):
+        self.paid = paid
+        self.checks = 0
+        self.issues = 0
+
+    async def check(self, pay_id):
+        self.checks += 1
+        await asyncio.sleep(0.01)
+        return {'chat_id': '1'} if self.paid else False
+
+    async def handler(self, pay_id, metadata):
+        self.issues += 1
+        await asyncio.sleep(0.01)
+        return f'key-{pay_id}', True
+
+    async def lookup(self, pay_id):
+        return None
+
+def new_settlement(fake) -> settlement.Settlement:
+    return settlement.Settlement(fake.handler, fake.lookup, workers=1)
+
+def test_simultaneous_taps_issue_one_key():
+    fake = FakePayment()
+
+    async def scenario():
+        pipeline = new_settlement(fake)
+        return await asyncio.gather(*[pipeline.confirm('pay', fake.check) for _ in range(TAPS)])
+
+    results = asyncio.run(scenario())
+
+    assert fake.checks == 1
+    assert fake.issues == 1
+    assert all(key == 'key-pay' and paid for key, _, paid, _ in results)
+    # Only one tap reports the new key, others remind it
+    assert sum(issued_now for _, issued_now, _, _ in results) == 1
+    assert sum(owner for _, _, _, owner in results) == 1
+
+def test_taps_after_settlement_use_cache():
+    fake = FakePayment()
+
+    async def scenario():
+        pipeline = new_settlement(fake)
+        await pipeline.confirm('pay', fake.check)
+        return await asyncio.gather(*[pipeline.confirm('pay', fake.check) for _ in range(TAPS)])
+
+    results = asyncio.run(scenario())
+
+    assert fake.checks == 1
+    assert fake.issues == 1
+    assert not any(issued_now for _, issued_now, _, _ in results)
+
+def test_unpaid_taps_issue_nothing():
+    fake = FakePayment(paid=False)
+
+    async def scenario():
+        pipeline = new_settlement(fake)
+        return await asyncio.gather(*[pipeline.confirm('pay', fake.check) for _ in range(TAPS)])
+
+    results = asyncio.run(scenario())
+
+    assert fake.checks == 1
+    assert fake.issues == 0
+    assert all(key is None and not paid for key, _, paid, _ in results)
+
+# YooKassa notification is being settled while user taps confirmation
+def test_taps_during_notification_issue_one_key():
+    fake = FakePayment()
+
+    async def scenario():
+        pipeline = new_settlement(fake)
+        notification = asyncio.ensure_future(pipeline.settle('pay', {'chat_id': '1'}))
+        await asyncio.sleep(0)
+        taps = await asyncio.gather(*[pipeline.confirm('pay', fake.check) for _ in range(TAPS)])
+        return await notification, taps
+
+    (key, issued_now), taps = asyncio.run(scenario())
+
+    assert fake.checks == 0
+    assert fake.issues == 1
+    assert key == 'key-pay' and issued_now
+    assert all(key == 'key-pay' and paid and not issued_now for key, issued_now, paid, _ in taps)
@@ -0,0 +1,103 @@
+# Incoming updates limits: one user mashing buttons must not turn into a flood of YooKassa and database calls
+# Budget: one dict lookup, one bucket update and a comparison per update, no API calls for dropped updates
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from collections import OrderedDict
+
+import metrics
+
+from sender import TokenBucket
+
+# Budgets: cheap menu messages and callbacks, expensive payment callbacks
+MENU = 'menu'
+PAYMENT = 'payment'
+
+# Callbacks that create or check payments
+PAYMENT_PREFIXES = ('plan', 'pay')
+
+throttled = metrics.Counter('bot_throttled_total', 'Updates dropped by anti-flood limits', ('budget', 'reason'))
+
+# Limits of one chat
+class ChatLimits():
+    __slots__ = ('buckets', 'last_key', 'last_time', 'seen')
+
+    def __init__(self):
+        self.buckets = {}
+        self.last_key = None
+        self.last_time = 0
+        self.seen = 0
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # budgets: {budget: (rate per second, burst)}
+    # debounce: same text or button from the same chat within this many seconds is dropped
+    def __init__(self, budgets, debounce, max_chats, idle, exempt=()):
+        self.budgets = budgets
+        self.debounce = debounce
+        self.max_chats = max_chats
+        self.idle = idle # Chats without updates for this many seconds are forgotten
+        self.exempt = frozenset(exempt)
+        self.chats = OrderedDict() # chat_id -> ChatLimits, least recently active first
+
+    # Limits of the chat, idle and extra chats are dropped from the old end
+    def chat(self, chat_id, now):
+        limits = self.chats.get(chat_id)
+        if limits is None:
+            limits = self.chats[chat_id] = ChatLimits()
+        else:
+            self.chats.move_to_end(chat_id)
+        limits.seen = now
+
+        while len(self.chats) > self.max_chats or next(iter(self.chats.values())).seen < now - self.idle:
+            self.chats.popitem(last=False)
+
+        return limits
+
+    # Returns (chat_id, budget, debounce key) of message or callback
+    # Exact type check: getattr() of missing pydantic attribute raises inside, isinstance() goes through metaclass hook
+    @staticmethod
+    def classify(event) -> tuple:
+        if type(event) is not CallbackQuery:
+            return event.chat.id, MENU, event.text
+
+        # Game callbacks have no data
+        data = event.data or ''
+        chat_id = event.message.chat.id if event.message else event.from_user.id
+        prefix = data.split(':', 1)[0]
+        if prefix in PAYMENT_PREFIXES or data.startswith('success_payment_'):
+            return chat_id, PAYMENT, data
+        return chat_id, MENU, data
+
+    # Check limits, returns reason to drop update or None
+    def check(self, chat_id, budget, key):
+        if chat_id in self.exempt:
+            return None
+
+        now = time.monotonic()
+        limits = self.chat(chat_id, now)
+
+        # Double taps and repeated commands, don't take tokens
+        if key is not None and key == limits.last_key and now - limits.last_time < self.debounce:
+            return 'debounce'
+        limits.last_key = key
+        limits.last_time = now
+
+        bucket = limits.buckets.get(budget)
+        if bucket is None:
+            rate, burst = self.budgets[budget]
+            bucket = limits.buckets[budget] = TokenBucket(rate, burst)
+
+        if not bucket.try_take():
+            return 'rate'
+        return None
+
+    async def __call__(self, handler, event, data):
+        chat_id, budget, key = self.classify(event)
+
+        reason = self.check(chat_id, budget, key)
+        if reason is not None:
+            throttled.inc(budget, reason)
+            return None
+
+        return await handler(event, data)